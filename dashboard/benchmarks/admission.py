@@ -0,0 +1,98 @@
+# Copyright [2019] [FORTH-ICS]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compare pod mutation patch generation, as done in webhooks.pod_mutate.
+# Run with: python -m dashboard.benchmarks.admission [--containers N ...] [--env N] [--repeat N]
+
+import argparse
+import copy
+import json
+import timeit
+import jsonpatch
+
+from types import SimpleNamespace
+
+from ..utils.inject import inject_volumes, inject_variables
+
+
+def make_context():
+    file_domains = {name: SimpleNamespace(volume_name='knot-%s' % name, mount_dir='/%s' % name) for name in ('private', 'shared', 'admin')}
+    local_data = {'username': 'user', 'namespace': 'knot-user', 'ingress_url': 'https://example.com',
+                  'private_dir': '/private', 'private_volume': 'knot-private', 'shared_dir': '/shared', 'shared_volume': 'knot-shared'}
+    return SimpleNamespace(file_domains=file_domains, local_data=local_data)
+
+def make_pod(containers, env):
+    ''' Build a pod with init and regular containers, each with env entries, mounts and resources. '''
+    def container(name):
+        return {'name': name,
+                'image': 'registry.example.com/%s:1.0' % name,
+                'command': ['/bin/sh', '-c', 'exec run --config /etc/config/%s.yaml' % name],
+                'env': [{'name': 'VAR_%d' % i, 'value': 'value-%d' % i} for i in range(env)],
+                'ports': [{'containerPort': 8080, 'protocol': 'TCP'}],
+                'resources': {'limits': {'cpu': '1', 'memory': '1Gi'}, 'requests': {'cpu': '100m', 'memory': '128Mi'}},
+                'volumeMounts': [{'name': 'config', 'mountPath': '/etc/config'}]}
+
+    return {'apiVersion': 'v1',
+            'kind': 'Pod',
+            'metadata': {'name': 'workflow-step', 'namespace': 'knot-user', 'labels': {'app': 'workflow'}},
+            'spec': {'initContainers': [container('init-%d' % i) for i in range(2)],
+                     'containers': [container('main-%d' % i) for i in range(containers)],
+                     'volumes': [{'name': 'config', 'configMap': {'name': 'config'}}]}}
+
+def inject_inplace(pod, context):
+    ''' The original implementation (covering init containers as well): mutate a copy, then diff it with the request. '''
+    service = copy.deepcopy(pod)
+    spec = service['spec']
+    spec.setdefault('volumes', [])
+    existing_names = [v['name'] for v in spec['volumes']]
+    for file_domain in context.file_domains.values():
+        if file_domain.volume_name not in existing_names:
+            spec['volumes'].append({'name': file_domain.volume_name,
+                                    'persistentVolumeClaim': {'claimName': file_domain.volume_name}})
+    containers = spec['initContainers'] + spec['containers']
+    for container in containers:
+        container.setdefault('volumeMounts', [])
+        existing_names = [v['name'] for v in container['volumeMounts']]
+        for file_domain in context.file_domains.values():
+            if file_domain.volume_name not in existing_names:
+                container['volumeMounts'].append({'name': file_domain.volume_name,
+                                                  'mountPath': file_domain.mount_dir})
+    for container in containers:
+        container.setdefault('env', [])
+        container['env'] += [{'name': ('knot_%s' % key).upper(), 'value': value} for key, value in context.local_data.items()]
+    return jsonpatch.JsonPatch.from_diff(pod, service).to_string()
+
+def inject_direct(pod, context):
+    return json.dumps(inject_volumes(pod, context.file_domains) + inject_variables(pod, context))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark pod mutation patch generation.')
+    parser.add_argument('--containers', type=int, nargs='+', default=[1, 10, 50], help='Containers per pod.')
+    parser.add_argument('--env', type=int, default=50, help='Environment variables per container.')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement (the best is reported).')
+    parser.add_argument('--number', type=int, default=100, help='Admissions per run.')
+    args = parser.parse_args()
+
+    context = make_context()
+    print('%10s %14s %14s %10s' % ('containers', 'diff (ms)', 'direct (ms)', 'speedup'))
+    for containers in args.containers:
+        pod = make_pod(containers, args.env)
+        if jsonpatch.apply_patch(pod, inject_inplace(pod, context)) != jsonpatch.apply_patch(pod, inject_direct(pod, context)):
+            parser.exit(1, 'Results differ for %d containers\n' % containers)
+        diff = min(timeit.repeat(lambda: inject_inplace(pod, context), number=args.number, repeat=args.repeat)) / args.number
+        direct = min(timeit.repeat(lambda: inject_direct(pod, context), number=args.number, repeat=args.repeat)) / args.number
+        print('%10d %14.4f %14.4f %9.1fx' % (containers, diff * 1000, direct * 1000, diff / direct))
+
+if __name__ == '__main__':
+    main()
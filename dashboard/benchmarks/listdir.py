@@ -0,0 +1,78 @@
+# Copyright [2019] [FORTH-ICS]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compare directory listing, as done in FileDomainPathWorker.listdir.
+# Run with: python -m dashboard.benchmarks.listdir [--entries N] [--dir PATH] [--repeat N]
+
+import os
+import argparse
+import tempfile
+import timeit
+
+from datetime import datetime
+from operator import itemgetter
+from types import SimpleNamespace
+
+from ..utils.file_domains.file import FileDomainPathWorker
+
+
+def populate(path, entries):
+    ''' Create files, with a directory every 10 entries. '''
+    for i in range(entries):
+        name = os.path.join(path, 'entry-%06d' % i)
+        if i % 10 == 0:
+            os.mkdir(name)
+        else:
+            with open(name, 'wb') as f:
+                f.write(b'x' * (i % 100))
+
+def listdir_stat(path):
+    ''' The original implementation, with separate stat calls per entry. '''
+    worker = FileDomainPathWorker(SimpleNamespace(user_dir=path), [])
+    listing = []
+    real_path = worker.real_path
+    for name in os.listdir(worker.real_path):
+        if worker.isdir(name):
+            file_type = 'dir'
+        elif worker.isfile(name):
+            file_type = 'file'
+        else:
+            continue
+        listing.append({'name': name,
+                        'modified': datetime.fromtimestamp(os.path.getmtime(os.path.join(real_path, name))),
+                        'type': file_type,
+                        'size': os.path.getsize(os.path.join(real_path, name)) if file_type != 'dir' else 0})
+    return listing
+
+def listdir_scandir(path):
+    return FileDomainPathWorker(SimpleNamespace(user_dir=path), []).listdir()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark directory listing.')
+    parser.add_argument('--entries', type=int, default=100000, help='Entries in the synthetic directory.')
+    parser.add_argument('--dir', help='Where to create the synthetic directory (use a network filesystem to see the effect of stat round trips).')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement (the best is reported).')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as path:
+        populate(path, args.entries)
+        if sorted(listdir_stat(path), key=itemgetter('name')) != sorted(listdir_scandir(path), key=itemgetter('name')):
+            parser.exit(1, 'Results differ\n')
+        stat = min(timeit.repeat(lambda: listdir_stat(path), number=1, repeat=args.repeat))
+        scandir = min(timeit.repeat(lambda: listdir_scandir(path), number=1, repeat=args.repeat))
+        print('%10s %12s %12s %10s' % ('entries', 'stat (s)', 'scandir (s)', 'speedup'))
+        print('%10d %12.4f %12.4f %9.1fx' % (args.entries, stat, scandir, stat / scandir))
+
+if __name__ == '__main__':
+    main()
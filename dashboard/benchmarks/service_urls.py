@@ -0,0 +1,117 @@
+# Copyright [2019] [FORTH-ICS]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compare service to ingress URL resolution, as done in ServiceManager.list.
+# Run with: python -m dashboard.benchmarks.service_urls [--services N] [--repeat N]
+
+import argparse
+import timeit
+
+from datetime import datetime
+from types import SimpleNamespace
+
+from ..services import resolve_services
+
+
+def make_namespace(count):
+    ''' Build synthetic releases, services, and ingresses (one of each per service). '''
+    releases = []
+    services = []
+    ingresses = []
+    for i in range(count):
+        name = 'service-%d' % i
+        releases.append({'name': name, 'chart': 'nginx-1.0.%d' % (i % 10)})
+        services.append(SimpleNamespace(metadata=SimpleNamespace(name=name,
+                                                                 annotations={'meta.helm.sh/release-name': name},
+                                                                 labels={},
+                                                                 creation_timestamp=datetime.now())))
+        path = SimpleNamespace(path='/', backend=SimpleNamespace(service=SimpleNamespace(name=name)))
+        rule = SimpleNamespace(host='%s-user.example.com' % name, http=SimpleNamespace(paths=[path]))
+        ingresses.append(SimpleNamespace(spec=SimpleNamespace(rules=[rule])))
+    return services, ingresses, releases
+
+def resolve_services_nested(services, ingresses, releases, scheme):
+    ''' The original implementation, with a nested loop over ingresses for each service. '''
+    contents = []
+    for service in services:
+        try:
+            release_name = service.metadata.annotations['meta.helm.sh/release-name']
+        except:
+            continue
+        release = next((release for release in releases if release['name'] == release_name), None)
+        if not release:
+            continue
+
+        try:
+            if 'knot-hidden' in service.metadata.labels.keys():
+                continue
+        except:
+            pass
+
+        name = service.metadata.name
+        url = None
+        for ingress in ingresses:
+            try:
+                release_name = service.metadata.annotations['meta.helm.sh/release-name']
+            except:
+                continue
+            if release_name != release['name']:
+                continue
+            try:
+                for rule in ingress.spec.rules:
+                    for path in rule.http.paths:
+                        if path.backend.service.name == name and rule.host:
+                            url = '%s://%s%s' % (scheme, rule.host, path.path if (path.path and path.path != '/') else '')
+                            break
+                    if url:
+                        break
+            except:
+                pass
+            if url:
+                break
+
+        try:
+            chart_parts = release['chart'].split('-')
+            chart_name = '-'.join(chart_parts[:-1])
+            chart_version = chart_parts[-1]
+        except:
+            chart_name = ''
+            chart_version = None
+
+        contents.append({'name': name,
+                         'url': url,
+                         'created': service.metadata.creation_timestamp,
+                         'release': release,
+                         'chart': chart_name,
+                         'version': chart_version})
+
+    return contents
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark service to ingress URL resolution.')
+    parser.add_argument('--services', type=int, nargs='+', default=[100, 1000, 3000], help='Services (and ingresses) per namespace.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement (the best is reported).')
+    args = parser.parse_args()
+
+    print('%10s %12s %12s %10s' % ('services', 'nested (s)', 'indexed (s)', 'speedup'))
+    for count in args.services:
+        services, ingresses, releases = make_namespace(count)
+        if resolve_services_nested(services, ingresses, releases, 'https') != resolve_services(services, ingresses, releases, 'https'):
+            parser.exit(1, 'Results differ for %d services\n' % count)
+        nested = min(timeit.repeat(lambda: resolve_services_nested(services, ingresses, releases, 'https'), number=1, repeat=args.repeat))
+        indexed = min(timeit.repeat(lambda: resolve_services(services, ingresses, releases, 'https'), number=1, repeat=args.repeat))
+        print('%10d %12.4f %12.4f %9.1fx' % (count, nested, indexed, nested / indexed))
+
+if __name__ == '__main__':
+    main()
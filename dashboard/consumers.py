@@ -13,30 +13,83 @@
 # limitations under the License.
 
 import json
+import time
+import asyncio
 
-from channels.generic.websocket import WebsocketConsumer
-from asgiref.sync import async_to_sync
+from django.conf import settings
+from channels.generic.websocket import AsyncWebsocketConsumer
 
+from .utils.metrics import Counter, Gauge, Histogram
 
-class UpdatesConsumer(WebsocketConsumer):
-    def connect(self):
+
+websocket_connections = Gauge('knot_websocket_connections', 'Open update websockets.')
+websocket_connections_total = Counter('knot_websocket_connections_total', 'Update websockets accepted.')
+websocket_idle_closes_total = Counter('knot_websocket_idle_closes_total', 'Update websockets closed for inactivity.')
+websocket_messages_total = Counter('knot_websocket_messages_total', 'Update messages sent to websockets.')
+websocket_send_seconds = Histogram('knot_websocket_send_seconds', 'Time from sending an update to writing it to a websocket.')
+
+class UpdatesConsumer(AsyncWebsocketConsumer):
+    '''
+    Sends user-specific updates. Clients are expected to send "ping" periodically
+    (answered with "pong"); connections silent for longer than the idle timeout are closed.
+    '''
+
+    group_name = None
+    idle_task = None
+
+    async def connect(self):
         self.user = self.scope['user']
         if not self.user.is_authenticated:
-            self.close()
+            await self.close()
+            return
 
         self.group_name = 'updates_%s' % self.user.username
 
         # Join group of user-specific updates.
-        async_to_sync(self.channel_layer.group_add)(self.group_name, self.channel_name)
-        self.accept()
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+        websocket_connections.inc()
+        websocket_connections_total.inc()
+        self.last_seen = time.monotonic()
+        self.idle_task = asyncio.ensure_future(self.close_when_idle()) if settings.WEBSOCKET_IDLE_TIMEOUT else None
+
+    async def disconnect(self, close_code):
+        if not self.group_name:
+            return
 
-    def disconnect(self, close_code):
         # Leave group of user-specific updates.
-        async_to_sync(self.channel_layer.group_discard)(self.group_name, self.channel_name)
+        websocket_connections.dec()
+        if self.idle_task:
+            self.idle_task.cancel()
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def close_when_idle(self):
+        while True:
+            idle = time.monotonic() - self.last_seen
+            if idle > settings.WEBSOCKET_IDLE_TIMEOUT:
+                websocket_idle_closes_total.inc()
+                await self.close()
+                return
+            await asyncio.sleep(settings.WEBSOCKET_IDLE_TIMEOUT - idle + 1)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        self.last_seen = time.monotonic()
+        if text_data == 'ping':
+            await self.send(text_data=json.dumps({'message': 'pong'}))
 
     # Receive message for group.
-    def update_message(self, event):
+    async def update_message(self, event):
         message = event['message']
+        data = event.get('data') or {}
 
         # Send message over WebSocket.
-        self.send(text_data=json.dumps({'message': message}))
+        await self.send(text_data=json.dumps(dict(data, message=message)))
+        websocket_messages_total.inc()
+        if 'sent' in event:
+            websocket_send_seconds.observe(max(time.time() - event['sent'], 0))
+
+    # Receive a batch of messages for group.
+    async def update_messages(self, event):
+        for update in event['messages']:
+            await self.update_message(update)
@@ -15,6 +15,7 @@
 from django.conf import settings as django_settings
 
 from .models import User
+from .tasks import pending_reconcile_tasks
 
 
 def settings(request):
@@ -41,3 +42,9 @@ def teams(request):
         pass
 
     return {'teams': result}
+
+def workspace(request):
+    if not request.user.is_authenticated:
+        return {}
+
+    return {'workspace_preparing': pending_reconcile_tasks(request.user).exists()}
@@ -0,0 +1,120 @@
+# Copyright [2019] [FORTH-ICS]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import stat
+
+from collections import defaultdict
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from .models import DirectoryIndex
+
+
+INDEXED_FIELDS = ('parent', 'mtime_ns', 'own_size', 'own_files', 'size', 'files')
+BATCH_SIZE = 500
+
+def file_domain_roots():
+    ''' The top-level directories of all file domains (per-user private folders are right below "private"). '''
+    return [os.path.join(settings.FILES_MOUNT_DIR, name) for name in ('private', 'shared', 'admin')]
+
+class DirectoryIndexer(object):
+    '''
+    Updates the DirectoryIndex table for a tree. Files are only listed again in
+    directories whose mtime changed (entries added, removed, or renamed), so
+    content changes to existing files are picked up when doing a "full" pass.
+    The chart's indexing cronjob runs hourly and does a full pass weekly, so sizes
+    of files written in place lag behind by at most a week.
+    '''
+
+    def __init__(self, full=False):
+        self.full = full
+        self.scanned = 0
+        self.skipped = 0
+
+    def _walk(self, path, parent, st):
+        row = self._rows.get(path)
+        if row and not self.full and row.mtime_ns == st.st_mtime_ns:
+            own_size, own_files = row.own_size, row.own_files
+            subdirs = self._children[path]
+            self.skipped += 1
+        else:
+            own_size = own_files = 0
+            subdirs = []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            own_size += entry.stat(follow_symlinks=False).st_size
+                            own_files += 1
+                    except OSError:
+                        continue
+            self.scanned += 1
+
+        size, files = own_size, own_files
+        for subdir in subdirs:
+            try:
+                subdir_st = os.lstat(subdir)
+                if not stat.S_ISDIR(subdir_st.st_mode):
+                    continue
+                subdir_size, subdir_files = self._walk(subdir, path, subdir_st)
+            except OSError: # Removed while walking.
+                continue
+            size += subdir_size
+            files += subdir_files
+
+        values = {'parent': parent,
+                  'mtime_ns': st.st_mtime_ns,
+                  'own_size': own_size,
+                  'own_files': own_files,
+                  'size': size,
+                  'files': files}
+        self._seen.add(path)
+        if not row:
+            self._created.append(DirectoryIndex(path=path, **values))
+        elif any(getattr(row, k) != v for k, v in values.items()):
+            for k, v in values.items():
+                setattr(row, k, v)
+            self._updated.append(row)
+        return size, files
+
+    def update(self, path):
+        ''' Index the tree at path and return its (size, files). '''
+        path = os.path.normpath(path)
+        rows = DirectoryIndex.objects.filter(Q(path=path) | Q(path__startswith=path + '/'))
+        self._rows = {row.path: row for row in rows}
+        self._children = defaultdict(list)
+        for row in self._rows.values():
+            if row.parent:
+                self._children[row.parent].append(row.path)
+        self._seen = set()
+        self._created = []
+        self._updated = []
+
+        try:
+            st = os.lstat(path)
+            result = self._walk(path, os.path.dirname(path), st) if stat.S_ISDIR(st.st_mode) else (0, 0)
+        except FileNotFoundError:
+            result = (0, 0)
+
+        with transaction.atomic():
+            DirectoryIndex.objects.bulk_create(self._created, batch_size=BATCH_SIZE)
+            DirectoryIndex.objects.bulk_update(self._updated, INDEXED_FIELDS, batch_size=BATCH_SIZE)
+            removed = [row.pk for p, row in self._rows.items() if p not in self._seen]
+            for i in range(0, len(removed), BATCH_SIZE):
+                DirectoryIndex.objects.filter(pk__in=removed[i:i + BATCH_SIZE]).delete()
+        return result
@@ -0,0 +1,34 @@
+# Copyright [2019] [FORTH-ICS]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...indexer import DirectoryIndexer, file_domain_roots
+
+
+class Command(BaseCommand):
+    help = 'Updates directory sizes and file counts for the file domains.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='Directories to index (all file domains by default).')
+        parser.add_argument('--full', action='store_true', default=False, help='List all directories, not only the ones that changed (needed to pick up writes to existing files).')
+
+    def handle(self, *args, **options):
+        for path in options['paths'] or file_domain_roots():
+            indexer = DirectoryIndexer(full=options['full'])
+            start = time.monotonic()
+            size, files = indexer.update(path)
+            print('%s: %i bytes in %i files (%i directories listed, %i unchanged, %.2f seconds).' % (path, size, files, indexer.scanned, indexer.skipped, time.monotonic() - start))
@@ -0,0 +1,65 @@
+# Copyright [2019] [FORTH-ICS]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import connection
+
+from ...models import User
+from ...utils.kubernetes import PrefetchedKubernetesClient
+
+
+class Command(BaseCommand):
+    help = 'Provisions namespaces, volumes, and credentials for all active users (and teams).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help='Only reconcile these users.')
+        parser.add_argument('--workers', type=int, default=8, help='Users to reconcile in parallel.')
+        parser.add_argument('--force', action='store_true', default=False, help='Provision even if nothing has changed.')
+
+    def reconcile(self, user, kubernetes_client, force):
+        start = time.monotonic()
+        try:
+            result = 'updated' if user.create_namespace(force=force, kubernetes_client=kubernetes_client) else 'unchanged'
+        except Exception as e:
+            result = 'failed (%s)' % str(e).splitlines()[0] if str(e) else 'failed'
+        finally:
+            connection.close() # Each thread has its own connection.
+        return result, time.monotonic() - start
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        users = User.objects.filter(is_active=True).order_by('username')
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+        users = list(users)
+
+        # One client (and connection pool) for all, with existing objects looked up once.
+        kubernetes_client = PrefetchedKubernetesClient()
+        kubernetes_client.prefetch([settings.ARGO_WORKFLOWS_NAMESPACE] if settings.ARGO_WORKFLOWS_NAMESPACE else [])
+        print('Fetched cluster state in %.2f seconds.' % (time.monotonic() - start))
+
+        counts = {}
+        with ThreadPoolExecutor(max_workers=max(options['workers'], 1)) as executor:
+            futures = {executor.submit(self.reconcile, user, kubernetes_client, options['force']): user for user in users}
+            for future in as_completed(futures):
+                result, duration = future.result()
+                print('%s: %s in %.2f seconds.' % (futures[future].username, result, duration))
+                result = result.split(' ')[0]
+                counts[result] = counts.get(result, 0) + 1
+
+        print('%i users reconciled in %.2f seconds (%s).' % (len(users), time.monotonic() - start, ', '.join('%i %s' % (v, k) for k, v in sorted(counts.items())) or 'none'))
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.6 on 2026-10-18 20:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0009_upload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirectoryIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.TextField(unique=True)),
+                ('parent', models.TextField(db_index=True, null=True)),
+                ('mtime_ns', models.BigIntegerField()),
+                ('own_size', models.BigIntegerField(default=0)),
+                ('own_files', models.BigIntegerField(default=0)),
+                ('size', models.BigIntegerField(default=0)),
+                ('files', models.BigIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.1.6 on 2026-10-18 20:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0010_directoryindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProvisioningState',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='provisioning_state', serialize=False, to='dashboard.user')),
+                ('spec_hash', models.CharField(max_length=64)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
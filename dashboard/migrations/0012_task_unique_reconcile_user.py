@@ -0,0 +1,26 @@
+# Generated by Django 5.1.6 on 2026-10-18 20:55
+
+from django.db import migrations, models
+
+
+def remove_duplicate_reconcile_tasks(apps, schema_editor):
+    Task = apps.get_model('dashboard', 'Task')
+    seen = set()
+    for task in Task.objects.filter(name='reconcile_user').order_by('-created'):
+        if task.user_id in seen:
+            task.delete()
+        seen.add(task.user_id)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0011_provisioningstate'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_reconcile_tasks, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='task',
+            constraint=models.UniqueConstraint(condition=models.Q(('name', 'reconcile_user')), fields=('user', 'name'), name='unique_reconcile_user_task'),
+        ),
+    ]
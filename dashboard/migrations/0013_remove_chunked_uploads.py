@@ -0,0 +1,49 @@
+# Generated by Django 5.1.6 on 2026-10-18 22:10
+
+import os
+
+from django.conf import settings
+from django.db import migrations
+
+
+CHUNKED_UPLOAD_TABLE = 'chunked_upload_chunkedupload'
+
+def remove_chunked_uploads(apps, schema_editor):
+    '''
+    Clean up after django-chunked-upload, which is no longer installed. Completed uploads
+    were deleted with their files, so remaining rows point to abandoned partial files
+    (under "uploads" in the files mount). Remove them and the table.
+    '''
+
+    connection = schema_editor.connection
+    if CHUNKED_UPLOAD_TABLE not in connection.introspection.table_names():
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT file FROM %s' % schema_editor.quote_name(CHUNKED_UPLOAD_TABLE))
+        names = [row[0] for row in cursor.fetchall()]
+    for name in names:
+        if not name:
+            continue
+        try:
+            os.remove(os.path.join(settings.FILES_MOUNT_DIR, name))
+        except OSError:
+            pass
+    for root, dirs, files in os.walk(os.path.join(settings.FILES_MOUNT_DIR, 'uploads'), topdown=False):
+        try:
+            os.rmdir(root) # Only if empty.
+        except OSError:
+            pass
+
+    schema_editor.execute('DROP TABLE %s' % schema_editor.quote_name(CHUNKED_UPLOAD_TABLE))
+    schema_editor.execute("DELETE FROM django_migrations WHERE app = 'chunked_upload'")
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0012_task_unique_reconcile_user'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_chunked_uploads, migrations.RunPython.noop),
+    ]
@@ -13,23 +13,28 @@
 # limitations under the License.
 
 import os
+import json
+import uuid
+import hashlib
 
 from django.db import models
 from django.contrib.auth.models import User as AuthUser, update_last_login
 from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_save, post_delete
 from django.contrib import messages
 from django.dispatch import receiver
 from django.conf import settings
+from django.utils import timezone
+from datetime import timedelta
 from urllib.parse import urlparse
 from jinja2 import Template
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 from impersonate.signals import session_begin
 
 from .utils.kubernetes import KubernetesClient
 from .utils.file_domains.file import PrivateFileDomain, SharedFileDomain, AdminFileDomain
 from .utils.file_domains.nfs import PrivateNFSDomain, SharedNFSDomain, AdminNFSDomain
 from .utils.harbor import HarborClient
+from .utils.notifications import notification_dispatcher
 
 
 NAMESPACE_TEMPLATE = '''
@@ -89,6 +94,8 @@ subjects:
   namespace: {{ argo_namespace }}
 '''
 
+PROVISIONING_RECHECK = timedelta(days=1) # Check the cluster at least this often, even if nothing changed.
+
 NEXTFLOW_CONFIG = '''
 process {
   executor = 'k8s'
@@ -166,12 +173,12 @@ class User(AuthUser):
                          'shared_registry_url': '%s/%s' % (settings.HARBOR_URL, 'library')})
         return data
 
-    def send_update(self, message):
-        channel_layer = get_channel_layer()
-        group_name = 'updates_%s' % self.username
-        async_to_sync(channel_layer.group_send)(group_name, {'type': 'update_message', 'message': message})
+    def send_update(self, message, **data):
+        ''' Notify open dashboard pages. Extra keyword arguments are passed along as a structured payload. '''
+        notification_dispatcher.send('updates_%s' % self.username, message, data)
 
     def update_kubernetes_credentials(self, kubernetes_client=None):
+        ''' Write the credentials secret right away (the rest of the namespace is provisioned in the background). '''
         if settings.VOUCH_URL:
             return
 
@@ -179,6 +186,7 @@ class User(AuthUser):
 
         if not kubernetes_client:
             kubernetes_client = KubernetesClient()
+        self.ensure_namespace(kubernetes_client)
         kubernetes_client.update_secret(self.namespace, 'knot-auth', [self.literal_auth])
 
     def delete_kubernetes_credentials(self, kubernetes_client=None):
@@ -215,20 +223,60 @@ class User(AuthUser):
         # Create private project.
         harbor_client.add_user_to_project(self, self.username, HarborClient.ROLE_ADMIN, public=False)
 
-    def create_namespace(self, request):
-        kubernetes_client = KubernetesClient()
+    def provisioning_spec(self):
+        ''' Everything that provisioning depends on (when it changes, the namespace is provisioned again). '''
+        return {'version': settings.VERSION,
+                'namespace': self.namespace,
+                'file_domains': {name: [domain.url, domain.volume_name, domain.user_dir] for name, domain in self.file_domains.items()},
+                'harbor': [settings.HARBOR_URL, bool(settings.HARBOR_ADMIN_PASSWORD)],
+                'jupyterhub': [settings.JUPYTERHUB_NOTEBOOK_DIR, settings.JUPYTERHUB_NEXTFLOW_DIR],
+                'argo': settings.ARGO_WORKFLOWS_NAMESPACE}
 
-        # Create namespace.
-        if self.namespace not in [n.metadata.name for n in kubernetes_client.list_namespaces()]:
+    @property
+    def provisioning_hash(self):
+        return hashlib.sha256(json.dumps(self.provisioning_spec(), sort_keys=True).encode()).hexdigest()
+
+    def is_provisioned(self, spec_hash=None):
+        ''' True if the namespace was provisioned with the current spec, recently enough. '''
+        try:
+            state = self.provisioning_state
+        except ProvisioningState.DoesNotExist:
+            return False
+        return state.spec_hash == (spec_hash or self.provisioning_hash) and state.updated > timezone.now() - PROVISIONING_RECHECK
+
+    def apply_namespace(self, kubernetes_client):
+        if not kubernetes_client.get_namespace(self.namespace):
             namespace_template = Template(NAMESPACE_TEMPLATE).render(name=self.namespace)
             kubernetes_client.apply_yaml_data(namespace_template.encode())
 
+    def ensure_namespace(self, kubernetes_client=None):
+        ''' Create just the namespace right away if missing, and queue provisioning everything else unless done. '''
+        from .tasks import enqueue_reconcile_user
+
+        if not kubernetes_client:
+            kubernetes_client = KubernetesClient()
+        self.apply_namespace(kubernetes_client)
+        if not self.is_provisioned():
+            enqueue_reconcile_user(self)
+
+    def create_namespace(self, request=None, force=False, kubernetes_client=None):
+        ''' Provision the namespace and everything around it, unless already done. Return True if any work was done. '''
+        spec_hash = self.provisioning_hash
+        if not force and self.is_provisioned(spec_hash):
+            return False
+
+        if not kubernetes_client:
+            kubernetes_client = KubernetesClient()
+
+        # Create namespace.
+        self.apply_namespace(kubernetes_client)
+
         # Create or update registry secret.
         self.update_registry_credentials(kubernetes_client)
 
         # Create volumes.
         for name, domain in self.file_domains.items():
-            domain.create_domain()
+            domain.create_domain(kubernetes_client)
 
         # Create directory for Jupyter notebooks.
         if settings.JUPYTERHUB_NOTEBOOK_DIR:
@@ -263,15 +311,19 @@ class User(AuthUser):
         # Create service account for Argo.
         if settings.ARGO_WORKFLOWS_NAMESPACE:
             argo_service_account_name = self.namespace
-            if (argo_service_account_name not in [s.metadata.name for s in kubernetes_client.list_service_accounts(settings.ARGO_WORKFLOWS_NAMESPACE)] or
-                ("%s.service-account-token" % argo_service_account_name) not in [s.metadata.name for s in kubernetes_client.list_secrets(settings.ARGO_WORKFLOWS_NAMESPACE)]):
+            if (not kubernetes_client.get_service_account(settings.ARGO_WORKFLOWS_NAMESPACE, argo_service_account_name) or
+                not kubernetes_client.get_secret(settings.ARGO_WORKFLOWS_NAMESPACE, "%s.service-account-token" % argo_service_account_name)):
                 argo_template = Template(ARGO_SERVICE_ACCOUNT_TEMPLATE).render(name=self.username,
                                                                                namespace=self.namespace,
                                                                                argo_service_account=argo_service_account_name,
                                                                                argo_namespace=settings.ARGO_WORKFLOWS_NAMESPACE)
                 kubernetes_client.apply_yaml_data(argo_template.encode())
 
+        ProvisioningState.objects.update_or_create(user=self, defaults={'spec_hash': spec_hash})
+        return True
+
     def delete_namespace(self):
+        ProvisioningState.objects.filter(user=self).delete()
         kubernetes_client = KubernetesClient()
 
         # Delete service account for Argo.
@@ -328,16 +380,115 @@ class Task(models.Model):
     task_id = models.CharField(max_length=36, blank=False, null=False)
     created = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['user', 'name'], condition=models.Q(name='reconcile_user'), name='unique_reconcile_user_task')]
+
     @classmethod
     def add(cls, user, name, task_id):
         cls.objects.create(user=user, name=name, task_id=task_id)
 
+def generate_upload_id():
+    return uuid.uuid4().hex
+
+class ProvisioningState(models.Model):
+    ''' The spec a user's namespace was last provisioned with. '''
+
+    user = models.OneToOneField(User, primary_key=True, related_name='provisioning_state', on_delete=models.CASCADE)
+    spec_hash = models.CharField(max_length=64, blank=False, null=False)
+    updated = models.DateTimeField(auto_now=True)
+
+class Upload(models.Model):
+    user = models.ForeignKey(User, related_name='uploads', on_delete=models.CASCADE)
+    upload_id = models.CharField(max_length=32, unique=True, default=generate_upload_id, editable=False)
+    domain = models.CharField(max_length=16, blank=False, null=False)
+    path = models.TextField(blank=True, null=False)
+    filename = models.CharField(max_length=255, blank=False, null=False)
+    size = models.BigIntegerField(blank=False, null=False)
+    chunk_size = models.BigIntegerField(blank=False, null=False)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True) # Last chunk received.
+    finalizing = models.BooleanField(default=False) # Queued to be moved in place.
+
+    @property
+    def path_worker(self):
+        return self.user.file_domains[self.domain].path_worker([p for p in self.path.split('/') if p])
+
+    @property
+    def chunk_count(self):
+        return -(-self.size // self.chunk_size)
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    @property
+    def complete(self):
+        # Chunks sent again on retries are only counted once.
+        return self.chunks.count() >= self.chunk_count
+
+    def add_chunk(self, index):
+        UploadChunk.objects.bulk_create([UploadChunk(upload=self, index=index)], ignore_conflicts=True)
+        Upload.objects.filter(pk=self.pk).update(updated=timezone.now())
+
+    def finalize(self):
+        ''' Move the file in place and forget the upload. '''
+        try:
+            self.path_worker.commit_partial(self.upload_id, self.filename)
+        except:
+            self.discard()
+            raise
+        self.delete()
+
+    def discard(self):
+        try:
+            self.path_worker.remove_partial(self.upload_id)
+        except:
+            pass
+        self.delete()
+
+class UploadChunk(models.Model):
+    ''' A chunk of an upload that was written in full. '''
+
+    upload = models.ForeignKey(Upload, related_name='chunks', on_delete=models.CASCADE)
+    index = models.BigIntegerField(blank=False, null=False)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['upload', 'index'], name='unique_upload_chunk')]
+
+class DirectoryIndex(models.Model):
+    ''' Aggregate size and file count of a directory (and everything below it), as last indexed. '''
+
+    path = models.TextField(unique=True)
+    parent = models.TextField(db_index=True, null=True)
+    mtime_ns = models.BigIntegerField()
+    own_size = models.BigIntegerField(default=0) # Files directly in the directory.
+    own_files = models.BigIntegerField(default=0)
+    size = models.BigIntegerField(default=0) # Including subdirectories.
+    files = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def sizes(cls, parent):
+        ''' Map names of indexed subdirectories to (size, files). '''
+        return {os.path.basename(path): (size, files) for path, size, files in cls.objects.filter(parent=os.path.normpath(parent)).values_list('path', 'size', 'files')}
+
 @receiver(user_logged_in)
 def create_user_namespace(sender, user, request, **kwargs):
+    from .tasks import enqueue_reconcile_user
+
     user = User.objects.get(pk=user.pk)
     if not user.last_login:
         update_last_login(sender, user, **kwargs) # The first time, this handler may be called first
-    user.create_namespace(request) # Make sure namespace and volumes are created on upgrade
+    if not user.is_provisioned():
+        enqueue_reconcile_user(user) # Make sure namespace and volumes are created on upgrade (in the background)
+
+@receiver(post_save, sender=AuthUser)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=AuthUser)
+@receiver(post_delete, sender=User)
+def invalidate_user_admission_context(sender, instance, **kwargs):
+    from .webhooks import invalidate_admission_context
+
+    invalidate_admission_context('knot-%s' % instance.username)
 
 @receiver(session_begin)
 def impersonate(sender, impersonating, request, **kwargs):
@@ -12,18 +12,90 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import copy
 import random
 import string
 import tempfile
+import threading
 
 from django.conf import settings
 from urllib.parse import urlparse
 from ruamel.yaml import YAML
 
 from .utils.kubernetes import KubernetesClient
+from .utils.informers import CachedKubernetesClient
 from .utils.helm import flatten_values, unflatten_values, HelmLocalRepoClient, HelmClient
 
 
+_template_variables = {} # Chart path to (values.yaml key, chart name, variables).
+_template_variables_lock = threading.Lock()
+
+def index_ingress_urls(ingresses, scheme):
+    ''' Map each backend service name to the URL of the first ingress rule pointing to it. '''
+    urls = {}
+    for ingress in ingresses:
+        try:
+            rules = ingress.spec.rules or []
+        except:
+            continue
+        for rule in rules:
+            try:
+                if not rule.host:
+                    continue
+                for path in rule.http.paths:
+                    try:
+                        name = path.backend.service.name
+                    except:
+                        continue
+                    if name not in urls:
+                        urls[name] = '%s://%s%s' % (scheme, rule.host, path.path if (path.path and path.path != '/') else '')
+            except:
+                pass
+    return urls
+
+def resolve_services(services, ingresses, releases, scheme):
+    ''' Match services to their Helm releases and ingress URLs, skipping the rest. '''
+    releases_by_name = {release['name']: release for release in releases}
+    urls = index_ingress_urls(ingresses, scheme)
+
+    contents = []
+    for service in services:
+        # Keep only services that are part of releases.
+        try:
+            release_name = service.metadata.annotations['meta.helm.sh/release-name']
+        except:
+            continue
+        release = releases_by_name.get(release_name)
+        if not release:
+            continue
+
+        # Filter out services that are marked as hidden.
+        try:
+            if 'knot-hidden' in service.metadata.labels.keys():
+                continue
+        except:
+            pass
+
+        # Figure out the chart version.
+        try:
+            chart_parts = release['chart'].split('-')
+            chart_name = '-'.join(chart_parts[:-1])
+            chart_version = chart_parts[-1]
+        except:
+            chart_name = ''
+            chart_version = None
+
+        name = service.metadata.name
+        contents.append({'name': name,
+                         'url': urls.get(name),
+                         'created': service.metadata.creation_timestamp,
+                         'release': release,
+                         'chart': chart_name,
+                         'version': chart_version})
+
+    return contents
+
 class ServiceTemplateManager(object):
     def __init__(self, user):
         self.user = user
@@ -35,31 +107,49 @@ class ServiceTemplateManager(object):
                       'local': HelmLocalRepoClient('local', settings.SERVICES_REPO_DIR)}
         del(self.repos['local']) # Comment out to work on local charts.
 
+    def _template(self, repo_name, chart):
+        valid_keys = ('name', 'description', 'version')
+        template = {k: v for k, v in chart.items() if k in valid_keys}
+        template.update({'repo': repo_name, 'private': (repo_name == 'private')})
+        return template
+
     def get_template(self, name):
-        return next((chart for chart in self.list() if chart['name'] == name), None)
+        # Search in reverse order of precedence.
+        for repo_name, repo in reversed(self.repos.items()):
+            if not repo:
+                continue
+            if repo_name == 'local' and name in settings.DISABLED_SERVICES:
+                continue
+            chart = repo.get(name)
+            if chart:
+                return self._template(repo_name, chart)
+        return None
 
     def list(self):
         charts = {}
         for repo_name, repo in self.repos.items():
             if not repo:
                 continue
-            repo_charts = {name: dict(chart, repo=repo_name, private=(repo_name == 'private')) for name, chart in repo.list().items()}
+            repo_charts = {name: self._template(repo_name, chart) for name, chart in repo.list().items()}
             if repo_name == 'local':
                 repo_charts = {name: chart for name, chart in repo_charts.items() if name not in settings.DISABLED_SERVICES}
             charts.update(repo_charts)
 
-        valid_keys = ('name', 'description', 'version', 'repo', 'private')
-        return [{k: v for k, v in chart.items() if k in valid_keys} for name, chart in charts.items()]
+        return list(charts.values())
 
-    def variables(self, name):
+    def _variables(self, repo_client, name):
+        # Flattened variables are cached per chart, until values.yaml changes.
+        chart_path = repo_client.chart_path(name)
         try:
-            template = self.get_template(name)
-        except:
-            template = None
-        if not template:
-            raise KeyError
+            st = os.stat(os.path.join(chart_path, 'values.yaml'))
+            key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            key = None
+        with _template_variables_lock:
+            cached = _template_variables.get(chart_path)
+        if cached and key and cached[0] == key:
+            return cached[1], cached[2]
 
-        repo_client = self.repos[template['repo']]
         chart_name, values = repo_client.values(name)
         try:
             metadata = values['knot']['metadata']
@@ -69,16 +159,39 @@ class ServiceTemplateManager(object):
         data = flatten_values(values, 'data')
 
         # Customize interface with options in metadata.
+        data_by_label = {d['label']: d for d in data}
+        hidden = set()
         for k, v in dict(metadata).items():
-            value = next((d for d in data if d['label'] == ('data.%s' % k)), None)
+            label = 'data.%s' % k
+            value = data_by_label.get(label)
+            if not value:
+                continue
             if 'hidden' in v:
-                data.remove(value)
+                hidden.add(label)
             if 'title' in v:
                 value['title'] = v['title']
             if 'help' in v:
                 value['help'] = v['help']
             if 'choices' in v:
                 value['choices'] = v['choices']
+        data = tuple(d for d in data if d['label'] not in hidden)
+
+        if key:
+            with _template_variables_lock:
+                _template_variables[chart_path] = (key, chart_name, data)
+        return chart_name, data
+
+    def variables(self, name):
+        try:
+            template = self.get_template(name)
+        except:
+            template = None
+        if not template:
+            raise KeyError
+
+        repo_client = self.repos[template['repo']]
+        chart_name, cached_data = self._variables(repo_client, name)
+        data = copy.deepcopy(list(cached_data)) # Callers may change nested choices and defaults.
 
         data.insert(0, {'label': 'name',
                         'default': name,
@@ -89,76 +202,23 @@ class ServiceManager(object):
     def __init__(self, user):
         self.user = user
 
+    def _cached_kubernetes_client(self):
+        if not settings.KUBERNETES_CACHE_STALENESS:
+            return KubernetesClient()
+        return CachedKubernetesClient(staleness=settings.KUBERNETES_CACHE_STALENESS)
+
     def list(self):
-        kubernetes_client = KubernetesClient()
-        helm_client = HelmClient(kubernetes_client)
+        kubernetes_client = self._cached_kubernetes_client()
+        helm_client = HelmClient(kubernetes_client, native=settings.HELM_NATIVE_STORAGE)
         releases = helm_client.list(self.user.namespace)
-
-        ingress_url = urlparse(settings.INGRESS_URL)
-
-        contents = []
         ingresses = kubernetes_client.list_ingresses(namespace=self.user.namespace)
-        for service in kubernetes_client.list_services(namespace=self.user.namespace):
-            # Keep only services that are part of releases.
-            try:
-                release_name = service.metadata.annotations['meta.helm.sh/release-name']
-            except:
-                continue
-            release = next((release for release in releases if release['name'] == release_name), None)
-            if not release:
-                continue
+        services = kubernetes_client.list_services(namespace=self.user.namespace)
 
-            # Filter out services that are marked as hidden.
-            try:
-                if 'knot-hidden' in service.metadata.labels.keys():
-                    continue
-            except:
-                pass
-
-            # Get URL from associated ingress.
-            name = service.metadata.name
-            url = None
-            for ingress in ingresses:
-                try:
-                    release_name = service.metadata.annotations['meta.helm.sh/release-name']
-                except:
-                    continue
-                if release_name != release['name']:
-                    continue
-                try:
-                    for rule in ingress.spec.rules:
-                        for path in rule.http.paths:
-                            if path.backend.service.name == name and rule.host:
-                                url = '%s://%s%s' % (ingress_url.scheme, rule.host, path.path if (path.path and path.path != '/') else '')
-                                break
-                        if url:
-                            break
-                except:
-                    pass
-                if url:
-                    break
-
-            # Figure out the chart version.
-            try:
-                chart_parts = release['chart'].split('-')
-                chart_name = '-'.join(chart_parts[:-1])
-                chart_version = chart_parts[-1]
-            except:
-                chart_name = ''
-                chart_version = None
-
-            contents.append({'name': name,
-                             'url': url,
-                             'created': service.metadata.creation_timestamp,
-                             'release': release,
-                             'chart': chart_name,
-                             'version': chart_version})
-
-        return contents
+        return resolve_services(services, ingresses, releases, urlparse(settings.INGRESS_URL).scheme)
 
     def variables(self, name):
-        kubernetes_client = KubernetesClient()
-        helm_client = HelmClient(kubernetes_client)
+        kubernetes_client = self._cached_kubernetes_client()
+        helm_client = HelmClient(kubernetes_client, native=settings.HELM_NATIVE_STORAGE)
         try:
             release = next((r for r in helm_client.list(self.user.namespace) if r['name'] == name), None)
         except:
@@ -183,7 +243,7 @@ class ServiceManager(object):
             variable['value'] = value
 
         kubernetes_client = KubernetesClient()
-        helm_client = HelmClient(kubernetes_client)
+        helm_client = HelmClient(kubernetes_client, native=settings.HELM_NATIVE_STORAGE)
 
         # Resolve naming conflicts.
         name = data['name']
@@ -229,6 +289,6 @@ class ServiceManager(object):
 
         return name
 
-    def delete(self, name):
-        helm_client = HelmClient()
-        helm_client.uninstall(self.user.namespace, name, wait=False)
+    def delete(self, name, wait=False):
+        helm_client = HelmClient(native=settings.HELM_NATIVE_STORAGE)
+        helm_client.uninstall(self.user.namespace, name, wait=wait)
@@ -12,35 +12,133 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import subprocess
+import uuid
 
 from celery import shared_task
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from datetime import timedelta
 
-from .models import User
+from .models import User, Upload, Message, Task
 from .services import ServiceTemplateManager, ServiceManager
 
 
-@shared_task
-def create_service_task(user_id, service_name, variables, data, upgrade=False):
+def service_summary(user, name):
+    ''' Return the row shown in the services list for a newly created service (if visible). '''
+    try:
+        service = next((service for service in ServiceManager(user).list() if service['release']['name'] == name), None)
+    except:
+        return None
+    if not service:
+        return None
+    return {'name': service['name'],
+            'release': name,
+            'url': service['url'],
+            'created': service['created'].isoformat() if service['created'] else None}
+
+@shared_task(bind=True)
+def create_service_task(self, user_id, service_name, variables, data, upgrade=False):
     user = User.objects.get(pk=user_id)
+    task_id = self.request.id
+    user.send_update('create_service', task_id=task_id, state='started', release=data.get('name'), upgrade=upgrade)
 
     # Adds the Helm repository locally.
     template_manager = ServiceTemplateManager(user)
     try:
         chart_name, _ = template_manager.variables(service_name)
     except Exception as e:
-        user.send_update('create_service')
-        raise ValueError('Can not %s service: %s' % ('upgrade' if upgrade else 'create', str(e)))
+        error = 'Can not %s service: %s' % ('upgrade' if upgrade else 'create', str(e))
+        user.send_update('create_service', task_id=task_id, state='failed', release=data.get('name'), upgrade=upgrade, error=error)
+        raise ValueError(error)
 
     service_manager = ServiceManager(user)
     try:
         service_name = service_manager.create(chart_name, variables, data, upgrade=upgrade)
-    except subprocess.CalledProcessError as e:
-        user.send_update('create_service')
-        raise ValueError('Can not %s service: %s' % ('upgrade' if upgrade else 'create', str(e)))
     except Exception as e:
-        user.send_update('create_service')
-        raise ValueError('Can not %s service: %s' % ('upgrade' if upgrade else 'create', str(e)))
+        error = 'Can not %s service: %s' % ('upgrade' if upgrade else 'create', str(e))
+        user.send_update('create_service', task_id=task_id, state='failed', release=data.get('name'), upgrade=upgrade, error=error)
+        raise ValueError(error)
+
+    result = 'Service "%s" %s.' % (service_name, 'upgraded' if upgrade else 'created')
+    user.send_update('create_service', task_id=task_id, state='succeeded', release=service_name, upgrade=upgrade, result=result,
+                     service=None if upgrade else service_summary(user, service_name))
+    return result
+
+@shared_task(bind=True)
+def delete_service_task(self, user_id, service_name):
+    user = User.objects.get(pk=user_id)
+    task_id = self.request.id
+    user.send_update('delete_service', task_id=task_id, state='started', release=service_name)
+
+    service_manager = ServiceManager(user)
+    try:
+        service_manager.delete(service_name, wait=True)
+    except Exception as e:
+        error = 'Can not remove service "%s": %s' % (service_name, str(e))
+        user.send_update('delete_service', task_id=task_id, state='failed', release=service_name, error=error)
+        raise ValueError(error)
+
+    result = 'Service "%s" removed.' % service_name
+    user.send_update('delete_service', task_id=task_id, state='succeeded', release=service_name, result=result)
+    return result
+
+@shared_task(bind=True)
+def finalize_upload_task(self, upload_id):
+    upload = Upload.objects.get(upload_id=upload_id)
+    user, filename = upload.user, upload.filename
+    try:
+        upload.finalize()
+    except Exception as e:
+        error = 'Can not upload "%s": %s' % (filename, str(e))
+        Message.objects.create(user=user, level='error', message=error)
+        user.send_update('upload', task_id=self.request.id, state='failed', filename=filename, error=error)
+        raise ValueError(error)
+
+    result = 'File "%s" uploaded.' % filename
+    Message.objects.create(user=user, level='success', message=result)
+    user.send_update('upload', task_id=self.request.id, state='succeeded', filename=filename, result=result)
+    return result
+
+def pending_reconcile_tasks(user):
+    ''' Provisioning tasks queued or running for a user (rows are removed when tasks finish). '''
+    cutoff = timezone.now() - timedelta(seconds=settings.CELERY_TASK_TIME_LIMIT)
+    return Task.objects.filter(user=user, name='reconcile_user', created__gt=cutoff)
+
+def enqueue_reconcile_user(user, force=False):
+    ''' Queue provisioning for a user, unless it is already queued. Return the task id. '''
+    task = pending_reconcile_tasks(user).first()
+    if task:
+        return task.task_id
+
+    # Record the task before it can run, so it is never left behind. Only one row is
+    # allowed per user, so concurrent callers do not both queue a task.
+    task_id = str(uuid.uuid4())
+    Task.objects.filter(user=user, name='reconcile_user').exclude(pk__in=pending_reconcile_tasks(user)).delete()
+    try:
+        with transaction.atomic():
+            Task.add(user, 'reconcile_user', task_id)
+    except IntegrityError:
+        task = pending_reconcile_tasks(user).first()
+        return task.task_id if task else None
+    reconcile_user_task.apply_async((user.pk,), {'force': force}, task_id=task_id)
+    return task_id
+
+@shared_task(bind=True)
+def reconcile_user_task(self, user_id, force=False):
+    user = User.objects.get(pk=user_id)
+    task_id = self.request.id
+    user.send_update('reconcile_user', task_id=task_id, state='started')
+
+    try:
+        user.create_namespace(force=force)
+    except Exception as e:
+        error = 'Can not prepare workspace: %s' % str(e)
+        user.send_update('reconcile_user', task_id=task_id, state='failed', error=error)
+        raise ValueError(error)
+    finally:
+        Task.objects.filter(user=user, name='reconcile_user', task_id=task_id).delete()
 
-    user.send_update('create_service')
-    return 'Service "%s" %s.' % (service_name, 'upgraded' if upgrade else 'created')
+    result = 'Workspace ready.'
+    user.send_update('reconcile_user', task_id=task_id, state='succeeded', result=result)
+    return result
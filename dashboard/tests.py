@@ -1,3 +1,663 @@
-# from django.test import TestCase
+# Copyright [2019] [FORTH-ICS]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
 
-# Create your tests here.
+import io
+import os
+import json
+import gzip
+import base64
+import time
+import zipfile
+import tempfile
+import jsonpatch
+
+from types import SimpleNamespace
+from collections import OrderedDict
+from unittest import mock
+from kubernetes.client.exceptions import ApiException
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from django.test import TestCase, SimpleTestCase, RequestFactory, override_settings
+from asgiref.sync import async_to_sync
+
+from . import views, webhooks, tasks
+from .models import User, Upload, Task, ProvisioningState, PROVISIONING_RECHECK
+from .utils import helm
+from .utils.informers import Informer
+from .utils.notifications import NotificationDispatcher
+from .utils.base64 import base64_encode
+from .utils.downloads import file_response, parse_range
+from .utils.file_domains.file import FileDomainPathWorker
+from .utils.helm import HelmReleaseStorage, HelmClient, HELM_RELEASE_SECRET_TYPE
+from .utils.inject import inject_volumes, inject_variables
+from .utils.kubernetes import KubernetesClient, SECRET_UPDATE_ATTEMPTS
+from .utils.zipstream import stream_zip
+
+
+class HelmReleaseStorageTest(SimpleTestCase):
+    def secret(self, name, version, status='deployed', compress=True, uid=None):
+        release = {'name': name,
+                   'namespace': 'default',
+                   'version': version,
+                   'info': {'status': status},
+                   'chart': {'metadata': {'name': 'chart', 'version': '1.0.%d' % version, 'appVersion': '2.0'},
+                             'templates': [{'name': 'big', 'data': 'x' * 100}]},
+                   'config': {'key': 'value'},
+                   'manifest': 'apiVersion: v1'}
+        data = json.dumps(release).encode()
+        if compress:
+            data = gzip.compress(data)
+        return SimpleNamespace(type=HELM_RELEASE_SECRET_TYPE,
+                               data={'release': base64_encode(base64_encode(data))},
+                               metadata=SimpleNamespace(uid=uid, resource_version='1', labels={'name': name, 'version': str(version)}))
+
+    def storage(self, secrets):
+        return HelmReleaseStorage(SimpleNamespace(list_secrets=lambda namespace, label_selector=None: secrets))
+
+    def test_decode(self):
+        for compress in (True, False):
+            release = self.storage([self.secret('one', 1, compress=compress)]).get('default', 'one')
+            self.assertEqual(release['name'], 'one')
+            self.assertEqual(release['info'], {'status': 'deployed'})
+            self.assertEqual(release['config'], {'key': 'value'})
+            self.assertEqual(release['chart'], {'metadata': {'name': 'chart', 'version': '1.0.1', 'appVersion': '2.0'}})
+
+    def test_latest_revision(self):
+        secrets = [self.secret('one', 1, status='superseded'), self.secret('one', 3), self.secret('one', 2, status='superseded')]
+        self.assertEqual(self.storage(secrets).get('default', 'one')['version'], 3)
+
+    def test_list(self):
+        secrets = [self.secret('one', 1),
+                   self.secret('two', 1, status='failed'),
+                   self.secret('three', 1, status='uninstalling'),
+                   SimpleNamespace(type='Opaque', data={'release': ''}, metadata=None)]
+        self.assertEqual(sorted(release['name'] for release in self.storage(secrets).list('default')), ['one', 'two'])
+
+    def test_missing(self):
+        with self.assertRaises(KeyError):
+            self.storage([]).get('default', 'one')
+
+    def test_format(self):
+        client = HelmClient(kubernetes_client=SimpleNamespace(list_secrets=lambda namespace, label_selector=None: [self.secret('one', 2, uid='abc')]))
+        self.assertEqual(client.list('default'), [{'name': 'one',
+                                                   'namespace': 'default',
+                                                   'revision': '2',
+                                                   'status': 'deployed',
+                                                   'chart': 'chart-1.0.2',
+                                                   'app_version': '2.0'}])
+
+    def test_cache_eviction(self):
+        storage = self.storage([])
+        secrets = [self.secret(name, 1, uid=name) for name in ('one', 'two', 'three')]
+        with mock.patch.object(helm, 'HELM_RELEASE_CACHE_SIZE', 2), mock.patch.object(helm, '_decoded_releases', OrderedDict()):
+            storage._decode_secret(secrets[0])
+            storage._decode_secret(secrets[1])
+            storage._decode_secret(secrets[0]) # Now the most recently used.
+            storage._decode_secret(secrets[2])
+            self.assertEqual([key[0] for key in helm._decoded_releases], ['one', 'three'])
+
+class InformerTest(SimpleTestCase):
+    def item(self, name, resource_version):
+        return SimpleNamespace(metadata=SimpleNamespace(name=name, resource_version=resource_version))
+
+    def test_relist_on_gone(self):
+        listings = [SimpleNamespace(items=[self.item('one', '1')], metadata=SimpleNamespace(resource_version='1')),
+                    SimpleNamespace(items=[self.item('one', '5'), self.item('two', '5')], metadata=SimpleNamespace(resource_version='5'))]
+        list_func = mock.Mock(side_effect=listings)
+        informer = Informer(list_func, 'default')
+        resource_versions = []
+
+        def stream(func, resource_version=None, **kwargs):
+            resource_versions.append(resource_version)
+            if len(resource_versions) == 1:
+                raise ApiException(status=410)
+            yield {'type': 'ADDED', 'object': self.item('three', '6')}
+            informer._stopped.set()
+
+        watch = mock.Mock()
+        watch.stream.side_effect = stream
+        with mock.patch('kubernetes.watch.Watch', return_value=watch), mock.patch.object(informer._stopped, 'wait') as wait:
+            informer._run()
+
+        # The stale resourceVersion is dropped and the objects are listed again, without backing off.
+        self.assertEqual(list_func.call_count, 2)
+        self.assertEqual(resource_versions, ['1', '5'])
+        wait.assert_not_called()
+        self.assertEqual(sorted(informer._store), ['one', 'three', 'two'])
+        self.assertEqual(informer._resource_version, '6')
+
+    def test_stale_answers_directly(self):
+        list_func = mock.Mock(return_value=SimpleNamespace(items=[self.item('one', '1')], metadata=SimpleNamespace(resource_version='1')))
+        informer = Informer(list_func, 'default')
+        informer._thread = True # Not started.
+        self.assertEqual([item.metadata.name for item in informer.list(30)], ['one'])
+        self.assertEqual(list_func.call_count, 1)
+
+class MetricsTest(SimpleTestCase):
+    def get(self, **headers):
+        return views.metrics(RequestFactory().get('/ws/metrics', **headers))
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token(self):
+        self.assertEqual(self.get().status_code, 401)
+        self.assertEqual(self.get(HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        response = self.get(HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+
+    @override_settings(METRICS_TOKEN='')
+    def test_disabled(self):
+        self.assertEqual(self.get(HTTP_AUTHORIZATION='Bearer ').status_code, 401)
+
+class FakeChannelLayer(object):
+    def __init__(self, fail=()):
+        self.sent = []
+        self.fail = fail
+
+    async def group_send(self, group, message):
+        if group in self.fail:
+            raise ConnectionError('Unavailable')
+        self.sent.append((group, message))
+
+@override_settings(NOTIFICATION_DELAY=60)
+class NotificationDispatcherTest(SimpleTestCase):
+    def send(self, channel_layer, updates):
+        dispatcher = NotificationDispatcher()
+        with mock.patch('dashboard.utils.notifications.get_channel_layer', return_value=channel_layer):
+            for group, message, data in updates:
+                dispatcher.send(group, message, data)
+            dispatcher.flush()
+
+    def test_coalescing(self):
+        channel_layer = FakeChannelLayer()
+        self.send(channel_layer, [('updates_one', 'create_service', {'task_id': 't1', 'state': 'queued'}),
+                                  ('updates_one', 'create_service', {'task_id': 't2', 'state': 'queued'}),
+                                  ('updates_one', 'create_service', {'task_id': 't1', 'state': 'started'}),
+                                  ('updates_one', 'create_service', {'task_id': 't1', 'state': 'succeeded'}),
+                                  ('updates_one', 'notification', {'text': 'hello'}),
+                                  ('updates_one', 'notification', {'text': 'hello'}),
+                                  ('updates_two', 'notification', {})])
+
+        # One event per group, with the latest update per task last.
+        sent = dict(channel_layer.sent)
+        self.assertEqual(sorted(sent), ['updates_one', 'updates_two'])
+        self.assertEqual(sent['updates_one']['type'], 'update_messages')
+        self.assertEqual([(m['message'], m['data']) for m in sent['updates_one']['messages']],
+                         [('create_service', {'task_id': 't2', 'state': 'queued'}),
+                          ('create_service', {'task_id': 't1', 'state': 'succeeded'}),
+                          ('notification', {'text': 'hello'})])
+        self.assertEqual(len(sent['updates_two']['messages']), 1)
+
+    def test_failures_logged(self):
+        channel_layer = FakeChannelLayer(fail=('updates_one',))
+        with self.assertLogs('dashboard.utils.notifications', level='ERROR') as logs:
+            self.send(channel_layer, [('updates_one', 'notification', {}), ('updates_two', 'notification', {})])
+        self.assertEqual([group for group, message in channel_layer.sent], ['updates_two'])
+        self.assertIn('updates_one', logs.output[0])
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                           'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'shared'}})
+class AdmissionContextTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='admission')
+        self.namespace = 'knot-admission'
+        webhooks._admission_contexts.clear()
+
+    def context(self):
+        version = async_to_sync(webhooks.admission_context_version)(self.namespace)
+        return webhooks.get_admission_context(self.namespace, version)
+
+    def test_cached(self):
+        context = self.context()
+        with self.assertNumQueries(0):
+            self.assertIs(self.context(), context)
+
+    def test_invalidated_on_change(self):
+        context = self.context()
+        self.assertNotIn('admin', context.file_domains)
+        version = async_to_sync(webhooks.admission_context_version)(self.namespace)
+
+        # Other processes keep their copy, but see the shared version change.
+        self.user.is_staff = True
+        self.user.save()
+        webhooks._admission_contexts[self.namespace] = (float('inf'), version, context)
+        self.assertIn('admin', self.context().file_domains)
+
+    def test_expired(self):
+        context = self.context()
+        with mock.patch('dashboard.webhooks.time.monotonic', return_value=time.monotonic() + webhooks.ADMISSION_CONTEXT_TTL + 1):
+            self.assertIsNot(self.context(), context)
+
+    def test_shared_cache_unavailable(self):
+        with mock.patch('dashboard.webhooks.caches') as caches:
+            caches.__getitem__.return_value.aget.side_effect = ConnectionError
+            self.assertIsNone(async_to_sync(webhooks.admission_context_version)(self.namespace))
+            self.assertIsNot(self.context(), self.context())
+
+class InjectTest(SimpleTestCase):
+    def setUp(self):
+        self.file_domains = {'private': SimpleNamespace(volume_name='knot-private', mount_dir='/private'),
+                             'shared': SimpleNamespace(volume_name='knot-shared', mount_dir='/shared')}
+        self.user = SimpleNamespace(local_data={'username': 'user', 'namespace': 'knot-user'})
+
+    def test_volumes_missing_lists(self):
+        pod = {'kind': 'Pod', 'spec': {'containers': [{'name': 'main'}]}}
+        volumes = [{'name': 'knot-private', 'persistentVolumeClaim': {'claimName': 'knot-private'}},
+                   {'name': 'knot-shared', 'persistentVolumeClaim': {'claimName': 'knot-shared'}}]
+        volume_mounts = [{'name': 'knot-private', 'mountPath': '/private'},
+                         {'name': 'knot-shared', 'mountPath': '/shared'}]
+        self.assertEqual(inject_volumes(pod, self.file_domains),
+                         [{'op': 'add', 'path': '/spec/volumes', 'value': volumes},
+                          {'op': 'add', 'path': '/spec/containers/0/volumeMounts', 'value': volume_mounts}])
+
+    def test_volumes_existing_lists(self):
+        deployment = {'kind': 'Deployment',
+                      'spec': {'template': {'spec': {'volumes': [{'name': 'knot-private', 'emptyDir': {}}],
+                                                     'initContainers': [{'name': 'init', 'volumeMounts': [{'name': 'knot-shared', 'mountPath': '/data'}]}],
+                                                     'containers': [{'name': 'main'}]}}}}
+        patch = inject_volumes(deployment, self.file_domains)
+        self.assertEqual(patch[0], {'op': 'add', 'path': '/spec/template/spec/volumes/-', 'value': {'name': 'knot-shared', 'persistentVolumeClaim': {'claimName': 'knot-shared'}}})
+        self.assertEqual(patch[1], {'op': 'add', 'path': '/spec/template/spec/initContainers/0/volumeMounts/-', 'value': {'name': 'knot-private', 'mountPath': '/private'}})
+
+        result = jsonpatch.apply_patch(deployment, patch)
+        spec = result['spec']['template']['spec']
+        self.assertEqual([v['name'] for v in spec['volumes']], ['knot-private', 'knot-shared'])
+        self.assertEqual([v['name'] for v in spec['initContainers'][0]['volumeMounts']], ['knot-shared', 'knot-private'])
+        self.assertEqual([v['name'] for v in spec['containers'][0]['volumeMounts']], ['knot-private', 'knot-shared'])
+
+    def test_variables(self):
+        cronjob = {'kind': 'CronJob',
+                   'spec': {'jobTemplate': {'spec': {'template': {'spec': {'containers': [{'name': 'main', 'env': [{'name': 'OTHER', 'value': 'value'}]},
+                                                                                          {'name': 'sidecar'}]}}}}}}
+        patch = inject_variables(cronjob, self.user)
+        self.assertEqual(patch[0], {'op': 'add', 'path': '/spec/jobTemplate/spec/template/spec/containers/0/env/-', 'value': {'name': 'KNOT_USERNAME', 'value': 'user'}})
+        containers = jsonpatch.apply_patch(cronjob, patch)['spec']['jobTemplate']['spec']['template']['spec']['containers']
+        self.assertEqual(containers[0]['env'], [{'name': 'OTHER', 'value': 'value'},
+                                                {'name': 'KNOT_USERNAME', 'value': 'user'},
+                                                {'name': 'KNOT_NAMESPACE', 'value': 'knot-user'}])
+        self.assertEqual(containers[1]['env'], [{'name': 'KNOT_USERNAME', 'value': 'user'}, {'name': 'KNOT_NAMESPACE', 'value': 'knot-user'}])
+
+    def test_variables_precedence(self):
+        env = [{'name': 'KNOT_USERNAME', 'value': 'other'},
+               {'name': 'KNOT_NAMESPACE', 'valueFrom': {'fieldRef': {'fieldPath': 'metadata.namespace'}}}]
+        pod = {'kind': 'Pod', 'spec': {'containers': [{'name': 'main', 'env': env}]}}
+        patch = inject_variables(pod, self.user)
+        self.assertEqual(patch, [{'op': 'replace', 'path': '/spec/containers/0/env/0', 'value': {'name': 'KNOT_USERNAME', 'value': 'user'}},
+                                 {'op': 'replace', 'path': '/spec/containers/0/env/1', 'value': {'name': 'KNOT_NAMESPACE', 'value': 'knot-user'}}])
+
+    def test_cascade(self):
+        # A pod created from a mutated template is mutated again, without changes.
+        deployment = {'kind': 'Deployment',
+                      'spec': {'template': {'spec': {'containers': [{'name': 'main', 'env': [{'name': 'KNOT_USERNAME', 'value': 'other'}]}]}}}}
+        deployment = jsonpatch.apply_patch(deployment, inject_volumes(deployment, self.file_domains) + inject_variables(deployment, self.user))
+        pod = {'kind': 'Pod', 'spec': deployment['spec']['template']['spec']}
+        self.assertEqual(inject_volumes(pod, self.file_domains) + inject_variables(pod, self.user), [])
+        self.assertEqual(pod['spec']['containers'][0]['env'], [{'name': 'KNOT_USERNAME', 'value': 'user'}, {'name': 'KNOT_NAMESPACE', 'value': 'knot-user'}])
+
+    def test_not_a_workload(self):
+        self.assertEqual(inject_volumes({'kind': 'Service', 'spec': {}}, self.file_domains), [])
+        self.assertEqual(inject_variables({'kind': 'Pod', 'spec': {}}, self.user), [])
+
+    def test_escaping(self):
+        pod = {'kind': 'Pod', 'spec': {'containers': [{'name': 'main'}]}}
+        file_domains = {'private': SimpleNamespace(volume_name='a/b~c', mount_dir='/private')}
+        result = jsonpatch.apply_patch(pod, inject_volumes(pod, file_domains))
+        self.assertEqual(result['spec']['volumes'][0]['name'], 'a/b~c')
+
+class StreamZipTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'data')
+        os.makedirs(os.path.join(self.path, 'sub'))
+        self.contents = {'data/text.txt': b'hello ' * 1000,
+                         'data/sub/archive.gz': os.urandom(1000),
+                         'data/sub/empty': b''}
+        for name, data in self.contents.items():
+            with open(os.path.join(self.directory.name, name), 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self, chunks):
+        zip_file = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+        self.assertIsNone(zip_file.testzip())
+        return zip_file
+
+    def test_round_trip(self):
+        zip_file = self.read(stream_zip(self.path))
+        self.assertEqual({name: zip_file.read(name) for name in zip_file.namelist()}, self.contents)
+        self.assertEqual(zip_file.getinfo('data/text.txt').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(zip_file.getinfo('data/sub/archive.gz').compress_type, zipfile.ZIP_STORED)
+
+    def test_stored(self):
+        zip_file = self.read(stream_zip(self.path, compress=False))
+        self.assertEqual({info.compress_type for info in zip_file.infolist()}, {zipfile.ZIP_STORED})
+        self.assertEqual(zip_file.read('data/text.txt'), self.contents['data/text.txt'])
+
+    def test_zip64(self):
+        # Lower the limits so that entries and the archive need ZIP64 records.
+        with mock.patch('zipfile.ZIP64_LIMIT', 100), mock.patch('zipfile.ZIP_FILECOUNT_LIMIT', 2):
+            chunks = list(stream_zip(self.path))
+        data = b''.join(chunks)
+        self.assertIn(zipfile.stringEndArchive64, data)
+        zip_file = self.read(chunks)
+        self.assertEqual(zip_file.read('data/sub/archive.gz'), self.contents['data/sub/archive.gz'])
+        self.assertEqual(zip_file.getinfo('data/text.txt').extra[:2], b'\x01\x00')
+
+class ListdirPageTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        for i in range(25):
+            with open(os.path.join(self.tmp.name, 'file%02d' % i), 'wb') as f:
+                f.write(b'x' * (i % 7))
+        for name in ('dir1', 'dir2', 'dir3'):
+            os.mkdir(os.path.join(self.tmp.name, name))
+        open(os.path.join(self.tmp.name, '.upload-partial'), 'wb').close()
+        self.path_worker = FileDomainPathWorker(SimpleNamespace(user_dir=self.tmp.name), [])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def walk(self, sort_by, order, limit, **kwargs):
+        names = []
+        cursor = None
+        while True:
+            page, cursor = self.path_worker.listdir_page(sort_by, order, limit=limit, cursor=cursor, **kwargs)
+            self.assertLessEqual(len(page), limit)
+            names += [entry['name'] for entry in page]
+            if not cursor:
+                return names
+
+    def test_listdir(self):
+        entries = {entry['name']: entry for entry in self.path_worker.listdir()}
+        self.assertEqual(len(entries), 28) # Without partial uploads.
+        self.assertEqual((entries['file09']['type'], entries['file09']['size']), ('file', 2))
+        self.assertEqual((entries['dir1']['type'], entries['dir1']['size']), ('dir', 0))
+
+        # Broken symlinks are left out.
+        os.symlink('missing', os.path.join(self.tmp.name, 'link'))
+        self.assertNotIn('link', [entry['name'] for entry in self.path_worker.listdir()])
+
+    def test_round_trip(self):
+        entries = self.path_worker.listdir()
+        for sort_by in ('name', 'size', 'modified'):
+            for order in ('asc', 'desc'):
+                for limit in (1, 4, 28, 100):
+                    names = self.walk(sort_by, order, limit)
+                    self.assertEqual(len(names), 28)
+                    self.assertEqual(set(names), set(entry['name'] for entry in entries))
+
+    def test_name_order(self):
+        names = sorted(entry['name'] for entry in self.path_worker.listdir())
+        self.assertEqual(self.walk('name', 'asc', 5), names)
+        self.assertEqual(self.walk('name', 'desc', 5), names[::-1])
+
+    def test_size_order_with_dir_sizes(self):
+        names = self.walk('size', 'desc', 3, dir_sizes={'dir2': (1000, 10)})
+        self.assertEqual(names[0], 'dir2')
+        page, cursor = self.path_worker.listdir_page('name', limit=1, dir_sizes={'dir2': (1000, 10)}, prefix='dir2')
+        self.assertEqual((page[0]['size'], page[0]['files']), (1000, 10))
+        self.assertIsNone(cursor)
+
+    def test_prefix(self):
+        self.assertEqual(self.walk('name', 'asc', 2, prefix='dir'), ['dir1', 'dir2', 'dir3'])
+
+    def test_invalid_cursor(self):
+        def cursor(value):
+            return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+        for sort_by, value in (('name', 'garbage'),
+                               ('name', cursor([1, 'file01'])),
+                               ('size', cursor(['file01', 'file01'])),
+                               ('size', cursor([True, 'file01'])),
+                               ('modified', cursor([1.5])),
+                               ('name', cursor({'a': 1}))):
+            with self.assertRaises(ValueError):
+                self.path_worker.listdir_page(sort_by, cursor=value)
+
+@override_settings(FILES_SENDFILE='')
+class FileResponseTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.NamedTemporaryFile()
+        self.tmp.write(bytes(range(256)) * 4)
+        self.tmp.flush()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        self.tmp.close()
+
+    def get(self, method='get', **headers):
+        request = getattr(self.factory, method)('/files/test', **headers)
+        return file_response(request, self.tmp.name, 'test.bin')
+
+    def content(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_full(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '1024')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('attachment', response['Content-Disposition'])
+        self.assertEqual(self.content(response), bytes(range(256)) * 4)
+
+    def test_range(self):
+        for header, start, end in (('bytes=0-9', 0, 9), ('bytes=1000-', 1000, 1023), ('bytes=-24', 1000, 1023), ('bytes=1020-5000', 1020, 1023)):
+            response = self.get(HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], 'bytes %d-%d/1024' % (start, end))
+            self.assertEqual(response['Content-Length'], str(end - start + 1))
+            self.assertEqual(self.content(response), (bytes(range(256)) * 4)[start:end + 1])
+
+    def test_unsatisfiable_range(self):
+        response = self.get(HTTP_RANGE='bytes=2000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1024')
+
+    def test_ignored_range(self):
+        for header in ('bytes=0-1,5-6', 'items=0-1', 'bytes=9-1'):
+            self.assertEqual(self.get(HTTP_RANGE=header).status_code, 200)
+        self.assertIsNone(parse_range(None, 1024))
+
+    def test_if_range(self):
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag).status_code, 206)
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"').status_code, 200)
+
+    def test_if_none_match(self):
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+        # The validator changes when the file does.
+        self.tmp.write(b'more')
+        self.tmp.flush()
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_head(self):
+        response = self.get(method='head')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '1024')
+        self.assertEqual(self.content(response), b'')
+
+    @override_settings(FILES_SENDFILE='x-accel-redirect', FILES_SENDFILE_PREFIX='/protected-files/')
+    def test_sendfile(self):
+        with override_settings(FILES_MOUNT_DIR=os.path.dirname(self.tmp.name)):
+            response = self.get()
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-files/' + os.path.basename(self.tmp.name))
+        self.assertEqual(response.content, b'')
+
+class UploadTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='upload')
+
+    def upload(self, size, chunk_size=4):
+        return Upload.objects.create(user=self.user, domain='private', path='', filename='test', size=size, chunk_size=chunk_size)
+
+    def test_chunks(self):
+        upload = self.upload(10)
+        self.assertEqual(upload.chunk_count, 3)
+        self.assertEqual([upload.chunk_length(i) for i in range(3)], [4, 4, 2])
+
+    def test_complete(self):
+        upload = self.upload(10)
+        self.assertFalse(upload.complete)
+        upload.add_chunk(0)
+        upload.add_chunk(2)
+        self.assertFalse(upload.complete)
+        upload.add_chunk(1)
+        self.assertTrue(upload.complete)
+
+    def test_retries_counted_once(self):
+        upload = self.upload(10)
+        for i in (0, 0, 1, 1, 0):
+            upload.add_chunk(i)
+        self.assertFalse(upload.complete)
+        self.assertEqual(upload.chunks.count(), 2)
+
+    def test_empty(self):
+        self.assertTrue(self.upload(0).complete)
+
+class UpsertSecretTest(SimpleTestCase):
+    def setUp(self):
+        self.client = KubernetesClient()
+        self.client._core_client = mock.Mock()
+        self.core_client = self.client._core_client
+
+    def created_secret(self, data):
+        # Create the secret and return it, as it would be read back.
+        self.core_client.read_namespaced_secret.side_effect = ApiException(status=404)
+        self.assertTrue(self.client.upsert_secret('knot-user', 'test', data))
+        self.core_client.read_namespaced_secret.side_effect = None
+        secret = self.core_client.create_namespaced_secret.call_args.args[1]
+        secret.metadata.resource_version = '1'
+        return secret
+
+    def test_unchanged(self):
+        self.core_client.read_namespaced_secret.return_value = self.created_secret({'key': 'value'})
+        self.assertFalse(self.client.upsert_secret('knot-user', 'test', {'key': 'value'}))
+        self.core_client.replace_namespaced_secret.assert_not_called()
+
+    def test_changed(self):
+        self.core_client.read_namespaced_secret.return_value = self.created_secret({'key': 'value'})
+        self.assertTrue(self.client.upsert_secret('knot-user', 'test', {'key': 'other'}))
+        secret = self.core_client.replace_namespaced_secret.call_args.args[2]
+        self.assertEqual(secret.data, {'key': base64_encode('other')})
+        self.assertEqual(secret.metadata.resource_version, '1')
+
+    def test_conflict_retried(self):
+        self.core_client.read_namespaced_secret.return_value = self.created_secret({'key': 'value'})
+        self.core_client.replace_namespaced_secret.side_effect = [ApiException(status=409), None]
+        self.assertTrue(self.client.upsert_secret('knot-user', 'test', {'key': 'other'}))
+        self.assertEqual(self.core_client.replace_namespaced_secret.call_count, 2)
+        self.assertEqual(self.core_client.read_namespaced_secret.call_count, 3)
+
+    def test_conflicts_exhausted(self):
+        self.core_client.read_namespaced_secret.return_value = self.created_secret({'key': 'value'})
+        self.core_client.replace_namespaced_secret.side_effect = ApiException(status=409)
+        with self.assertRaises(ApiException) as context:
+            self.client.upsert_secret('knot-user', 'test', {'key': 'other'})
+        self.assertEqual(context.exception.status, 409)
+        self.assertEqual(self.core_client.replace_namespaced_secret.call_count, SECRET_UPDATE_ATTEMPTS)
+
+@override_settings(VOUCH_URL=None, HARBOR_URL=None, JUPYTERHUB_NOTEBOOK_DIR=None, JUPYTERHUB_NEXTFLOW_DIR=None, ARGO_WORKFLOWS_NAMESPACE=None)
+class ProvisioningTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='provisioning')
+        self.kubernetes_client = mock.Mock()
+        self.kubernetes_client.get_namespace.return_value = None
+        patcher = mock.patch.object(User, 'file_domains', new_callable=mock.PropertyMock, return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_namespace(self, **kwargs):
+        return self.user.create_namespace(kubernetes_client=self.kubernetes_client, **kwargs)
+
+    def test_skipped_when_unchanged(self):
+        self.assertFalse(self.user.is_provisioned())
+        self.assertTrue(self.create_namespace())
+        self.assertTrue(self.user.is_provisioned())
+        self.kubernetes_client.reset_mock()
+        self.assertFalse(self.create_namespace())
+        self.assertFalse(User.objects.get(pk=self.user.pk).create_namespace(kubernetes_client=self.kubernetes_client))
+        self.assertEqual(self.kubernetes_client.mock_calls, [])
+
+    def test_forced(self):
+        self.assertTrue(self.create_namespace())
+        self.assertTrue(self.create_namespace(force=True))
+        self.assertEqual(self.kubernetes_client.apply_yaml_data.call_count, 2)
+
+    def test_spec_changed(self):
+        self.assertTrue(self.create_namespace())
+        with override_settings(VERSION='changed'):
+            self.assertFalse(self.user.is_provisioned())
+            self.assertTrue(self.create_namespace())
+
+    def test_rechecked(self):
+        self.assertTrue(self.create_namespace())
+        with mock.patch('dashboard.models.timezone.now', return_value=timezone.now() + PROVISIONING_RECHECK):
+            self.assertFalse(self.user.is_provisioned())
+            self.assertTrue(self.create_namespace())
+
+@override_settings(VOUCH_URL=None)
+class ReconcileTaskTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='reconcile')
+        patcher = mock.patch.object(tasks.reconcile_user_task, 'apply_async')
+        self.apply_async = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(User, 'file_domains', new_callable=mock.PropertyMock, return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_queued_once(self):
+        task_id = tasks.enqueue_reconcile_user(self.user)
+        self.assertEqual(tasks.enqueue_reconcile_user(self.user), task_id)
+        self.assertEqual(self.apply_async.call_count, 1)
+        self.assertEqual(Task.objects.filter(user=self.user).count(), 1)
+
+    def test_concurrent(self):
+        task_id = tasks.enqueue_reconcile_user(self.user)
+
+        # Another caller misses the row on the first check, and runs into it when adding its own.
+        pending = Task.objects.filter(user=self.user, name='reconcile_user')
+        with mock.patch.object(tasks, 'pending_reconcile_tasks', side_effect=[Task.objects.none(), pending, pending]):
+            self.assertEqual(tasks.enqueue_reconcile_user(self.user), task_id)
+        self.assertEqual(self.apply_async.call_count, 1)
+        self.assertEqual(Task.objects.filter(user=self.user).count(), 1)
+
+    def test_stale_replaced(self):
+        task_id = tasks.enqueue_reconcile_user(self.user)
+        with mock.patch('dashboard.tasks.timezone.now', return_value=timezone.now() + timedelta(seconds=settings.CELERY_TASK_TIME_LIMIT + 1)):
+            self.assertNotEqual(tasks.enqueue_reconcile_user(self.user), task_id)
+        self.assertEqual(self.apply_async.call_count, 2)
+        self.assertEqual(Task.objects.filter(user=self.user).count(), 1)
+
+    def test_credentials_queue_provisioning(self):
+        kubernetes_client = mock.Mock()
+        kubernetes_client.get_namespace.return_value = None
+        self.user.update_kubernetes_credentials(kubernetes_client)
+        kubernetes_client.apply_yaml_data.assert_called_once()
+        kubernetes_client.update_secret.assert_called_once_with(self.user.namespace, 'knot-auth', [self.user.literal_auth])
+        self.assertEqual(self.apply_async.call_count, 1)
+
+    def test_credentials_when_provisioned(self):
+        ProvisioningState.objects.create(user=self.user, spec_hash=self.user.provisioning_hash)
+        kubernetes_client = mock.Mock()
+        self.user.update_kubernetes_credentials(kubernetes_client)
+        kubernetes_client.apply_yaml_data.assert_not_called()
+        kubernetes_client.update_secret.assert_called_once()
+        self.apply_async.assert_not_called()
@@ -23,13 +23,16 @@ from . import webhooks
 urlpatterns = [
     path('', views.dashboard, name='dashboard'),
     path('services', views.services, name='services'),
+    path('services/tasks', views.service_tasks, name='service_tasks'),
     path('service/<str:name>', views.service_info, name='service_info'),
     path('service/create/<str:name>', views.service_create, name='service_create'),
     path('service/upgrade/<str:name>', views.service_upgrade, name='service_upgrade'),
     path('templates', views.templates, name='templates'),
     path('files', views.files, name='files'),
-    path('files/upload', views.UploadView.as_view(), name='files_upload'),
-    path('files/upload_complete', views.UploadCompleteView.as_view(), name='files_upload_complete'),
+    path('files/list/<path:path>', views.files_list, name='files_list'),
+    path('files/upload', views.files_upload, name='files_upload'),
+    path('files/upload/<str:upload_id>', views.files_upload_chunk, name='files_upload_chunk'),
+    path('files/upload/<str:upload_id>/complete', views.files_upload_complete, name='files_upload_complete'),
     path('files/<path:path>', views.files, name='files'),
     path('users', views.users, name='users'),
     path('user/edit/<str:username>', views.user_edit, name='user_edit'),
@@ -43,8 +46,11 @@ urlpatterns = [
     path('change_password', views.change_password, name='change_password'),
     path('logout', views.logout, {'next_url': settings.LOGOUT_REDIRECT_URL}, name='logout'),
 
+    path('ws/metrics', views.metrics, name='metrics'), # Served by the websocket server behind the proxy.
+
     path('webhooks/pod/mutate', webhooks.pod_mutate),
     path('webhooks/pod/validate', webhooks.pod_validate),
     path('webhooks/ingress/mutate', webhooks.ingress_mutate),
     path('webhooks/ingress/validate', webhooks.ingress_validate),
+    path('webhooks/metrics', views.metrics), # Served by the webhook server behind the proxy.
 ]
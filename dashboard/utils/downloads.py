@@ -0,0 +1,126 @@
+# Copyright [2019] [FORTH-ICS]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import mimetypes
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, content_disposition_header
+from urllib.parse import quote
+
+
+CHUNK_SIZE = 1024 * 1024
+
+def file_etag(st):
+    ''' A strong validator built from stat data (changes whenever the file is replaced or written). '''
+    return '"%x-%x-%x"' % (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def parse_range(header, size):
+    '''
+    Return the (start, end) byte positions (inclusive) requested by a single
+    "bytes=" range, None if the header should be ignored, or raise ValueError
+    if the range can not be satisfied.
+    '''
+
+    match = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', header or '')
+    if not match or not any(match.groups()):
+        return None # Missing, malformed, or multiple ranges: send the whole file.
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes.
+        length = int(last)
+        if not length or not size:
+            raise ValueError('Unsatisfiable range')
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError('Unsatisfiable range')
+    return start, end
+
+def read_file(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+def file_response(request, path, filename):
+    '''
+    Send a file as an attachment, honoring conditional requests (ETag and
+    Last-Modified) and single byte ranges. If FILES_SENDFILE is set, only send
+    headers and let the proxy in front serve the file.
+    '''
+
+    st = os.stat(path)
+    etag = file_etag(st)
+    last_modified = http_date(st.st_mtime)
+
+    # Answer "Not Modified" or "Precondition Failed" without opening the file.
+    response = get_conditional_response(request, etag=etag, last_modified=int(st.st_mtime))
+    if response is not None:
+        return response
+
+    content_type, encoding = mimetypes.guess_type(filename)
+    content_type = {'br': 'application/x-brotli',
+                    'bzip2': 'application/x-bzip',
+                    'compress': 'application/x-compress',
+                    'gzip': 'application/gzip',
+                    'xz': 'application/x-xz'}.get(encoding, content_type) or 'application/octet-stream'
+
+    if settings.FILES_SENDFILE in ('x-accel-redirect', 'x-sendfile'):
+        response = HttpResponse(content_type=content_type)
+        if settings.FILES_SENDFILE == 'x-accel-redirect':
+            relative_path = os.path.relpath(path, settings.FILES_MOUNT_DIR)
+            response['X-Accel-Redirect'] = quote(os.path.join(settings.FILES_SENDFILE_PREFIX, relative_path))
+        else:
+            response['X-Sendfile'] = path
+        response['Content-Disposition'] = content_disposition_header(True, filename)
+        response['ETag'] = etag
+        response['Last-Modified'] = last_modified
+        return response
+
+    # Ranges are only applied if the client's copy is still current.
+    byte_range = None
+    if request.method == 'GET' and 'HTTP_RANGE' in request.META:
+        if_range = request.META.get('HTTP_IF_RANGE', '').strip()
+        if not if_range or if_range == etag or parse_http_date_safe(if_range) == int(st.st_mtime):
+            try:
+                byte_range = parse_range(request.META['HTTP_RANGE'], st.st_size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % st.st_size
+                return response
+
+    start, end = byte_range if byte_range else (0, st.st_size - 1)
+    length = end - start + 1
+    response = StreamingHttpResponse(read_file(path, start, length) if request.method != 'HEAD' else [],
+                                     status=206 if byte_range else 200,
+                                     content_type=content_type)
+    if byte_range:
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, st.st_size)
+    response['Content-Length'] = str(length)
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    return response
@@ -13,16 +13,28 @@
 # limitations under the License.
 
 import os
-import zipfile
+import json
+import heapq
+import base64
+import time
 import shutil
+import threading
 
 from urllib.parse import urlparse
 from datetime import datetime
 from jinja2 import Template
 
 from ..kubernetes import KubernetesClient
+from ..zipstream import stream_zip
 
 
+PARTIAL_UPLOAD_PREFIX = '.upload-' # Files being uploaded (hidden from listings).
+LISTING_CACHE_SECONDS = 60
+LISTING_CACHE_SIZE = 32
+
+_listings = {} # Directory path to (key, listing).
+_listings_lock = threading.Lock()
+
 HOSTPATH_VOLUME_TEMPLATE = '''
 kind: PersistentVolumeClaim
 apiVersion: v1
@@ -77,22 +89,120 @@ class FileDomainPathWorker(object):
     def open(self, name, mode):
         return open(self.path_of(name), mode)
 
-    def listdir(self):
+    def _scandir(self, real_path):
+        # Entries with their types (usually no stat calls needed).
         listing = []
-        real_path = self.real_path
-        for name in os.listdir(self.real_path):
-            if self.isdir(name):
-                file_type = 'dir'
-            elif self.isfile(name):
-                file_type = 'file'
-            else:
+        with os.scandir(real_path) as entries:
+            for entry in entries:
+                if entry.name.startswith(PARTIAL_UPLOAD_PREFIX):
+                    continue
+                try:
+                    if entry.is_dir():
+                        listing.append((entry, 'dir'))
+                    elif entry.is_file():
+                        listing.append((entry, 'file'))
+                except OSError:
+                    continue
+        return listing
+
+    def _stat_entries(self, entries):
+        # DirEntry.stat() is cached, and only needs a system call for symlinks or the first time.
+        listing = []
+        for entry, file_type in entries:
+            try:
+                entry_stat = entry.stat()
+            except OSError:
                 continue
-            listing.append({'name': name,
-                            'modified': datetime.fromtimestamp(os.path.getmtime(os.path.join(real_path, name))),
+            listing.append({'name': entry.name,
+                            'modified': datetime.fromtimestamp(entry_stat.st_mtime),
                             'type': file_type,
-                            'size': os.path.getsize(os.path.join(real_path, name)) if file_type != 'dir' else 0})
+                            'size': entry_stat.st_size if file_type != 'dir' else 0})
         return listing
 
+    def listdir(self):
+        return self._stat_entries(self._scandir(self.real_path))
+
+    def _cached_listdir(self):
+        # Full listings are kept while the directory's mtime stays the same and
+        # for at most LISTING_CACHE_SECONDS, so that paging does not stat everything again.
+        real_path = self.real_path
+        key = (os.stat(real_path).st_mtime_ns, int(time.monotonic() // LISTING_CACHE_SECONDS))
+        with _listings_lock:
+            cached = _listings.get(real_path)
+        if cached and cached[0] == key:
+            return cached[1]
+
+        listing = tuple(self._stat_entries(self._scandir(real_path)))
+        with _listings_lock:
+            _listings[real_path] = (key, listing)
+            while len(_listings) > LISTING_CACHE_SIZE:
+                del _listings[next(iter(_listings))]
+        return listing
+
+    def listdir_page(self, sort_by='name', order='asc', limit=1000, cursor=None, prefix=None, dir_sizes=None):
+        '''
+        Return up to limit entries following the cursor in the given order, and the
+        cursor for the next page (None at the end). Entries are ordered by the sort
+        key, then by name, and only the requested page is sorted. Directory sizes
+        are taken from dir_sizes (name to size and file count), when given. When
+        sorting by name, only the entries of the returned page are stat'ed.
+        Raises ValueError for an invalid cursor.
+        '''
+
+        def key(entry):
+            value = entry[sort_by]
+            return (value.timestamp() if isinstance(value, datetime) else value, entry['name'])
+
+        if cursor:
+            try:
+                after = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            except (ValueError, UnicodeError):
+                raise ValueError('Invalid cursor')
+            # The cursor's value must be comparable to the sort key.
+            if not isinstance(after, list) or len(after) != 2 or not isinstance(after[1], str):
+                raise ValueError('Invalid cursor')
+            if sort_by == 'name':
+                valid = isinstance(after[0], str)
+            else:
+                valid = isinstance(after[0], (int, float)) and not isinstance(after[0], bool)
+            if not valid:
+                raise ValueError('Invalid cursor')
+            after = tuple(after)
+
+        def include(entry):
+            if prefix and not entry['name'].startswith(prefix):
+                return False
+            if cursor:
+                return key(entry) < after if order == 'desc' else key(entry) > after
+            return True
+
+        def select(entries):
+            entries = [entry for entry in entries if include(entry)]
+            if order == 'desc':
+                return heapq.nlargest(limit + 1, entries, key=key)
+            return heapq.nsmallest(limit + 1, entries, key=key)
+
+        if sort_by == 'name':
+            page = select({'name': entry.name, 'type': file_type, 'entry': entry} for entry, file_type in self._scandir(self.real_path))
+        else:
+            entries = self._cached_listdir()
+            if dir_sizes:
+                entries = [dict(entry, size=dir_sizes[entry['name']][0], files=dir_sizes[entry['name']][1])
+                           if entry['type'] == 'dir' and entry['name'] in dir_sizes else entry for entry in entries]
+            page = select(entries)
+
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = base64.urlsafe_b64encode(json.dumps(key(page[-1])).encode()).decode()
+        if sort_by == 'name':
+            page = self._stat_entries((entry['entry'], entry['type']) for entry in page)
+            if dir_sizes:
+                for entry in page:
+                    if entry['type'] == 'dir' and entry['name'] in dir_sizes:
+                        entry['size'], entry['files'] = dir_sizes[entry['name']]
+        return page, next_cursor
+
     def mkdir(self, name):
         os.mkdir(self.path_of(name))
 
@@ -105,16 +215,53 @@ class FileDomainPathWorker(object):
     def chown(self, name, uid, gid):
         os.chown(self.path_of(name), uid, gid)
 
-    def upload(self, filename, name):
-        shutil.move(filename, self.path_of(name))
-
-    def download(self, name, response):
-        zip_path = self.path_of(name)
-        with zipfile.ZipFile(response, 'w') as zip_file:
-            for root, dirs, files in os.walk(zip_path):
-                for file in files:
-                    zip_add_file = os.path.join(root, file)
-                    zip_file.write(zip_add_file, zip_add_file[len(os.path.dirname(zip_path)):])
+    def partial_name(self, upload_id):
+        return '%s%s' % (PARTIAL_UPLOAD_PREFIX, upload_id)
+
+    def create_partial(self, upload_id, size):
+        ''' Create the (sparse) file that chunks of an upload are written into, next to its destination. '''
+        fd = os.open(self.path_of(self.partial_name(upload_id)), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+
+    def write_partial(self, upload_id, offset, chunks):
+        ''' Write chunks at the given offset (chunks may arrive in any order). Return the bytes written. '''
+        written = 0
+        fd = os.open(self.path_of(self.partial_name(upload_id)), os.O_WRONLY)
+        try:
+            for chunk in chunks:
+                view = memoryview(chunk)
+                while view:
+                    count = os.pwrite(fd, view, offset + written)
+                    view = view[count:]
+                    written += count
+        finally:
+            os.close(fd)
+        return written
+
+    def commit_partial(self, upload_id, name, sync=True):
+        ''' Move a completed upload in place (a rename within the same folder). '''
+        partial_path = self.path_of(self.partial_name(upload_id))
+        if sync:
+            fd = os.open(partial_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        if self.exists(name):
+            raise FileExistsError('An item with the same name already exists')
+        os.rename(partial_path, self.path_of(name))
+
+    def remove_partial(self, upload_id):
+        try:
+            os.remove(self.path_of(self.partial_name(upload_id)))
+        except FileNotFoundError:
+            pass
+
+    def download(self, name, compress=True):
+        return stream_zip(self.path_of(name), compress=compress)
 
     def remove(self, name):
         os.remove(self.path_of(name))
@@ -129,15 +276,14 @@ class FileDomain(object):
         self._user = user
 
     def create_user_dir(self):
-        if not os.path.exists(self.user_dir):
-            os.makedirs(self.user_dir)
+        os.makedirs(self.user_dir, exist_ok=True)
 
     def delete_user_dir(self):
         raise NotImplementedError
 
-    def create_domain(self):
+    def create_domain(self, kubernetes_client=None):
         self.create_user_dir()
-        self.create_volume()
+        self.create_volume(kubernetes_client)
 
     def delete_domain(self):
         self.delete_volume()
@@ -209,11 +355,11 @@ class FileDomainAdmin(FileDomain):
         return os.path.join(self._mount_dir, 'admin')
 
 class HostpathVolumeMixin(object):
-    def create_volume(self):
+    def create_volume(self, kubernetes_client=None):
         # Create persistent volume and claim.
-        kubernetes_client = KubernetesClient()
-        volume_names = [pvc.metadata.name for pvc in kubernetes_client.list_persistent_volume_claims(namespace=self._user.namespace)]
-        if self.volume_name in volume_names:
+        if not kubernetes_client:
+            kubernetes_client = KubernetesClient()
+        if kubernetes_client.get_persistent_volume_claim(self._user.namespace, self.volume_name):
             return
 
         template = Template(HOSTPATH_VOLUME_TEMPLATE).render(name=self.volume_name,
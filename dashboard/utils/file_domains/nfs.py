@@ -56,11 +56,11 @@ spec:
 '''
 
 class NFSVolumeMixin(object):
-    def create_volume(self):
+    def create_volume(self, kubernetes_client=None):
         # Create persistent volume and claim.
-        kubernetes_client = KubernetesClient()
-        volume_names = [pvc.metadata.name for pvc in kubernetes_client.list_persistent_volume_claims(namespace=self._user.namespace)]
-        if self.volume_name in volume_names:
+        if not kubernetes_client:
+            kubernetes_client = KubernetesClient()
+        if kubernetes_client.get_persistent_volume_claim(self._user.namespace, self.volume_name):
             return
 
         template = Template(NFS_VOLUME_TEMPLATE).render(name=self.volume_name,
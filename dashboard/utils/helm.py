@@ -13,13 +13,26 @@
 # limitations under the License.
 
 import os
+import gzip
+import json
+import threading
 import subprocess
 import requests
 
+from collections import OrderedDict
 from ruamel.yaml import YAML
 from ruamel.yaml.comments import CommentedMap
 
 from .kubernetes import KubernetesClient
+from .base64 import base64_decode
+
+
+HELM_RELEASE_SECRET_TYPE = 'helm.sh/release.v1'
+HELM_GZIP_MAGIC = b'\x1f\x8b\x08'
+HELM_RELEASE_CACHE_SIZE = 1024
+
+_decoded_releases = OrderedDict() # Keyed by secret UID and resourceVersion (least recently used first).
+_decoded_releases_lock = threading.Lock()
 
 
 def flatten_values(values, prefix=''):
@@ -49,41 +62,203 @@ def unflatten_values(data):
         value_dict[key] = int(item['value']) if ('type' in item.keys() and item['type'] == 'int') else item['value']
     return values
 
-class HelmLocalRepoClient(object):
-    def __init__(self, repo_name, repo_path):
-        self._repo_name = repo_name
+def load_yaml(yaml_path):
+    if not os.path.isfile(yaml_path):
+        return None
+    try:
+        with open(yaml_path, 'rb') as f:
+            return YAML().load(f)
+    except:
+        return None
+
+class HelmChartCatalog(object):
+    '''
+    Parsed Chart.yaml metadata for the charts in a local repository, shared by the
+    whole process. A chart is only parsed again when the inode or modification time
+    of its directory or Chart.yaml changes, and the repository is only scanned again
+    when its own directory changes.
+    '''
+
+    _catalogs = {}
+    _catalogs_lock = threading.Lock()
+
+    @classmethod
+    def for_path(cls, repo_path):
+        with cls._catalogs_lock:
+            if repo_path not in cls._catalogs:
+                cls._catalogs[repo_path] = cls(repo_path)
+            return cls._catalogs[repo_path]
+
+    def __init__(self, repo_path):
         self._repo_path = repo_path
+        self._lock = threading.Lock()
+        self._repo_key = None
+        self._chart_paths = []
+        self._entries = {} # Chart path to (key, chart info).
+        self._by_name = {} # Chart name to chart path.
 
-    def _load_yaml(self, yaml_path):
-        if not os.path.isfile(yaml_path):
-            return None
+    def _stat_key(self, path):
+        st = os.stat(path)
+        return (st.st_ino, st.st_mtime_ns)
+
+    def _load_chart(self, chart_path):
         try:
-            with open(yaml_path, 'rb') as f:
-                return YAML().load(f)
-        except:
+            key = (self._stat_key(chart_path), self._stat_key(os.path.join(chart_path, 'Chart.yaml')))
+        except OSError:
+            self._entries.pop(chart_path, None)
             return None
+        entry = self._entries.get(chart_path)
+        if entry and entry[0] == key:
+            return entry[1]
+        chart_info = load_yaml(os.path.join(chart_path, 'Chart.yaml'))
+        if not chart_info or not chart_info.get('name'):
+            chart_info = None
+        self._entries[chart_path] = (key, chart_info)
+        return chart_info
+
+    def _refresh(self):
+        try:
+            repo_key = self._stat_key(self._repo_path)
+        except OSError:
+            repo_key = None
+        if repo_key != self._repo_key:
+            self._chart_paths = [d.path for d in os.scandir(self._repo_path) if d.is_dir()] if repo_key else []
+            self._entries = {path: self._entries[path] for path in self._chart_paths if path in self._entries}
+            self._repo_key = repo_key
+
+        by_name = {}
+        for chart_path in self._chart_paths:
+            chart_info = self._load_chart(chart_path)
+            if chart_info:
+                by_name[chart_info['name']] = chart_path
+        self._by_name = by_name
+
+    def charts(self):
+        with self._lock:
+            self._refresh()
+            return {name: self._entries[chart_path][1] for name, chart_path in self._by_name.items()}
+
+    def get(self, name):
+        with self._lock:
+            chart_path = self._by_name.get(name)
+            try:
+                changed = self._repo_key is None or self._stat_key(self._repo_path) != self._repo_key
+            except OSError:
+                changed = True
+            if not changed and chart_path:
+                # Check just this chart.
+                chart_info = self._load_chart(chart_path)
+                if chart_info and chart_info['name'] == name:
+                    return chart_info
+            self._refresh()
+            chart_path = self._by_name.get(name)
+            return self._entries[chart_path][1] if chart_path else None
+
+class HelmLocalRepoClient(object):
+    def __init__(self, repo_name, repo_path):
+        self._repo_name = repo_name
+        self._repo_path = repo_path
 
     def list(self, latest_only=True):
-        result = {}
-        if not os.path.isdir(self._repo_path):
-            return result
-        for chart_path in [os.path.join(d.path, 'Chart.yaml') for d in os.scandir(self._repo_path) if d.is_dir()]:
-            chart_info = self._load_yaml(chart_path)
-            if not chart_info:
-                continue
-            result[chart_info['name']] = chart_info
+        return HelmChartCatalog.for_path(self._repo_path).charts()
 
-        return result
+    def get(self, name):
+        return HelmChartCatalog.for_path(self._repo_path).get(name)
+
+    def chart_path(self, name):
+        return os.path.join(self._repo_path, name)
 
     def values(self, name):
-        chart_name = os.path.join(self._repo_path, name)
-        return chart_name, self._load_yaml(os.path.join(chart_name, 'values.yaml'))
+        chart_name = self.chart_path(name)
+        return chart_name, load_yaml(os.path.join(chart_name, 'values.yaml'))
+
+class HelmReleaseStorage(object):
+    '''
+    Reads releases directly from the secrets used by the Helm storage driver.
+    Each "sh.helm.release.v1.<name>.v<revision>" secret holds the release as
+    base64-encoded, gzipped JSON (on top of the base64 encoding of the secret).
+    '''
+
+    def __init__(self, kubernetes_client):
+        self.kubernetes_client = kubernetes_client
+
+    def _decode(self, data):
+        data = base64_decode(base64_decode(data))
+        if data[:3] == HELM_GZIP_MAGIC:
+            data = gzip.decompress(data)
+        return json.loads(data)
+
+    def _decode_secret(self, secret):
+        # Release secrets are immutable, but may be served repeatedly from a cache.
+        # Keep only the fields we use (not templates or manifests) and treat them as read-only.
+        key = (secret.metadata.uid, secret.metadata.resource_version)
+        release = None
+        if key[0]:
+            with _decoded_releases_lock:
+                release = _decoded_releases.get(key)
+                if release is not None:
+                    _decoded_releases.move_to_end(key)
+        if release is None:
+            release = self._decode(secret.data['release'])
+            release = {'name': release['name'],
+                       'namespace': release.get('namespace'),
+                       'version': release.get('version'),
+                       'info': {'status': release.get('info', {}).get('status')},
+                       'chart': {'metadata': release.get('chart', {}).get('metadata', {})},
+                       'config': release.get('config')}
+            if key[0]:
+                with _decoded_releases_lock:
+                    _decoded_releases[key] = release
+                    while len(_decoded_releases) > HELM_RELEASE_CACHE_SIZE:
+                        _decoded_releases.popitem(last=False)
+        return release
+
+    def _latest_secrets(self, namespace, name=None):
+        label_selector = 'owner=helm'
+        if name:
+            label_selector += ',name=%s' % name
+
+        # Keep only the latest revision of each release, using the labels to avoid decoding the rest.
+        latest = {}
+        for secret in self.kubernetes_client.list_secrets(namespace, label_selector=label_selector):
+            if secret.type != HELM_RELEASE_SECRET_TYPE or not secret.data or 'release' not in secret.data:
+                continue
+            try:
+                release_name = secret.metadata.labels['name']
+                revision = int(secret.metadata.labels['version'])
+            except:
+                continue
+            if release_name not in latest or latest[release_name][0] < revision:
+                latest[release_name] = (revision, secret)
+        return [secret for revision, secret in latest.values()]
+
+    def get(self, namespace, name):
+        secrets = self._latest_secrets(namespace, name)
+        if not secrets:
+            raise KeyError(name)
+        return self._decode_secret(secrets[0])
+
+    def list(self, namespace, statuses=('deployed', 'failed')):
+        releases = []
+        for secret in self._latest_secrets(namespace):
+            try:
+                release = self._decode_secret(secret)
+            except:
+                continue
+            if statuses and release.get('info', {}).get('status') not in statuses:
+                continue
+            releases.append(release)
+        return releases
 
 class HelmClient(object):
-    def __init__(self, kubernetes_client=None):
+    def __init__(self, kubernetes_client=None, native=True):
         self.kubernetes_client = kubernetes_client if kubernetes_client else KubernetesClient()
+        self.native = native
 
     def list(self, namespace):
+        if self.native:
+            return [self._format_release(release) for release in HelmReleaseStorage(self.kubernetes_client).list(namespace)]
+
         command = 'helm list -o yaml -n %s' % namespace
         result = subprocess.check_output(command, shell=True)
         releases = YAML().load(result)
@@ -91,7 +266,21 @@ class HelmClient(object):
             del(release['updated']) # We already have this as a datetime object.
         return releases
 
+    def _format_release(self, release):
+        # Same fields as in "helm list -o yaml" (without "updated").
+        chart_metadata = release.get('chart', {}).get('metadata', {})
+        return {'name': release['name'],
+                'namespace': release.get('namespace'),
+                'revision': str(release.get('version')),
+                'status': release.get('info', {}).get('status'),
+                'chart': '%s-%s' % (chart_metadata.get('name'), chart_metadata.get('version')),
+                'app_version': chart_metadata.get('appVersion', '')}
+
     def values(self, namespace, name):
+        if self.native:
+            config = HelmReleaseStorage(self.kubernetes_client).get(namespace, name).get('config') or {}
+            return YAML().load(json.dumps(config)) # Load as YAML to get the same types as with the command.
+
         command = 'helm get values -o yaml -n %s %s' % (namespace, name)
         result = subprocess.check_output(command, shell=True)
         return YAML().load(result)
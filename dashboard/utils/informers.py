@@ -0,0 +1,184 @@
+# Copyright [2019] [FORTH-ICS]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import threading
+
+import kubernetes.client
+import kubernetes.watch
+
+from .kubernetes import KubernetesClient
+
+
+WATCH_TIMEOUT = 10 # Seconds before a quiet watch is restarted (confirming the store is current).
+IDLE_TIMEOUT = 600 # Seconds before an informer nobody asks for is stopped.
+ERROR_BACKOFF = 5
+
+class Informer(object):
+    '''
+    Keeps an in-memory copy of the objects returned by a namespaced list call,
+    kept current by a watch stream that resumes from the last resourceVersion.
+    '''
+
+    def __init__(self, list_func, namespace, label_selector=None):
+        self._list_func = list_func
+        self._namespace = namespace
+        self._label_selector = label_selector
+        self._lock = threading.Lock()
+        self._store = {}
+        self._resource_version = None
+        self._synced = 0
+        self._accessed = time.monotonic()
+        self._stopped = threading.Event()
+        self._watch = None
+        self._thread = None
+
+    @property
+    def idle(self):
+        return time.monotonic() - self._accessed
+
+    def _kwargs(self):
+        kwargs = {'namespace': self._namespace}
+        if self._label_selector:
+            kwargs['label_selector'] = self._label_selector
+        return kwargs
+
+    def _relist(self):
+        result = self._list_func(**self._kwargs())
+        with self._lock:
+            self._store = {item.metadata.name: item for item in result.items}
+            self._resource_version = result.metadata.resource_version
+            self._synced = time.monotonic()
+
+    def _handle_event(self, event):
+        with self._lock:
+            if event['type'] == 'BOOKMARK':
+                self._resource_version = event['raw_object']['metadata']['resourceVersion']
+            else:
+                item = event['object']
+                if event['type'] == 'DELETED':
+                    self._store.pop(item.metadata.name, None)
+                else:
+                    self._store[item.metadata.name] = item
+                self._resource_version = item.metadata.resource_version
+            self._synced = time.monotonic()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                if self._resource_version is None:
+                    self._relist()
+                self._watch = kubernetes.watch.Watch()
+                for event in self._watch.stream(self._list_func,
+                                                resource_version=self._resource_version,
+                                                allow_watch_bookmarks=True,
+                                                timeout_seconds=WATCH_TIMEOUT,
+                                                _request_timeout=WATCH_TIMEOUT * 2,
+                                                **self._kwargs()):
+                    self._handle_event(event)
+                # The stream ended without errors, so nothing was missed.
+                with self._lock:
+                    self._synced = time.monotonic()
+            except kubernetes.client.exceptions.ApiException as e:
+                if e.status != 410: # Gone: the resourceVersion is too old, so list again.
+                    self._stopped.wait(ERROR_BACKOFF)
+                self._resource_version = None
+            except:
+                self._resource_version = None
+                self._stopped.wait(ERROR_BACKOFF)
+
+    def start(self):
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._watch:
+            self._watch.stop()
+
+    def list(self, staleness):
+        self._accessed = time.monotonic()
+        if not self._thread:
+            self._relist()
+            self.start()
+
+        with self._lock:
+            if self._resource_version is not None and time.monotonic() - self._synced <= staleness:
+                return list(self._store.values())
+
+        # The watch is lagging or failing, so answer directly.
+        return self._list_func(**self._kwargs()).items
+
+class InformerCache(object):
+    ''' Process-wide collection of informers, keyed by resource, namespace and label selector. '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._informers = {}
+        self._kubernetes_client = KubernetesClient()
+
+    def _list_func(self, resource):
+        if resource == 'services':
+            return self._kubernetes_client.core_client.list_namespaced_service
+        if resource == 'ingresses':
+            return self._kubernetes_client.networking_client.list_namespaced_ingress
+        if resource == 'secrets':
+            return self._kubernetes_client.core_client.list_namespaced_secret
+        raise ValueError('Unsupported resource')
+
+    def informer(self, resource, namespace, label_selector=None):
+        key = (resource, namespace, label_selector)
+        with self._lock:
+            # Stop informers for namespaces nobody looks at anymore.
+            for idle_key in [k for k, i in self._informers.items() if i.idle > IDLE_TIMEOUT]:
+                self._informers.pop(idle_key).stop()
+
+            informer = self._informers.get(key)
+            if not informer:
+                informer = Informer(self._list_func(resource), namespace, label_selector)
+                self._informers[key] = informer
+        return informer
+
+informer_cache = InformerCache()
+
+class CachedKubernetesClient(KubernetesClient):
+    '''
+    Answers list calls for services, ingresses, and Helm release secrets from
+    shared informers, as long as they have been in sync within "staleness" seconds.
+    '''
+
+    def __init__(self, staleness=30):
+        super().__init__()
+        self.staleness = staleness
+
+    def list_services(self, namespace):
+        if not namespace:
+            return super().list_services(namespace)
+        return informer_cache.informer('services', namespace).list(self.staleness)
+
+    def list_ingresses(self, namespace):
+        if not namespace:
+            return super().list_ingresses(namespace)
+        return informer_cache.informer('ingresses', namespace).list(self.staleness)
+
+    def list_secrets(self, namespace, label_selector=None):
+        # Only Helm release secrets are cached (further selectors are matched here).
+        if not namespace or not label_selector or label_selector.split(',')[0] != 'owner=helm':
+            return super().list_secrets(namespace, label_selector=label_selector)
+        match_labels = dict(term.split('=', 1) for term in label_selector.split(',')[1:])
+        secrets = informer_cache.informer('secrets', namespace, 'owner=helm').list(self.staleness)
+        return [s for s in secrets if all((s.metadata.labels or {}).get(k) == v for k, v in match_labels.items())]
@@ -15,79 +15,109 @@
 from urllib.parse import urlparse
 
 
-def inject_volumes(yaml_data, file_domains):
-    def add_volumes_to_spec(spec):
-        # Add volumes.
-        if 'volumes' not in spec:
-            spec['volumes'] = []
-        existing_names = [v['name'] for v in spec['volumes']]
-        for file_domain in file_domains.values():
-            if file_domain.volume_name in existing_names:
-                continue
-            spec['volumes'].append({'name': file_domain.volume_name,
-                                    'persistentVolumeClaim': {'claimName': file_domain.volume_name}})
-
-        # Mount volumes in containers.
-        for container in spec['containers']:
-            if 'volumeMounts' not in container:
-                container['volumeMounts'] = []
-            existing_names = [v['name'] for v in container['volumeMounts']]
-            for file_domain in file_domains.values():
-                if file_domain.volume_name in existing_names:
-                    continue
-                container['volumeMounts'].append({'name': file_domain.volume_name,
-                                                  'mountPath': file_domain.mount_dir})
+def json_pointer(*tokens):
+    return ''.join('/' + str(token).replace('~', '~0').replace('/', '~1') for token in tokens)
 
-    for part in yaml_data:
-        try:
-            if part['kind'] == 'Deployment':
-                spec = part['spec']['template']['spec']
-            elif part['kind'] == 'Pod':
-                spec = part['spec']
-            else:
-                continue
-        except:
-            continue
-        if not spec or 'containers' not in spec:
-            continue
-        add_volumes_to_spec(spec)
+# Where each workload kind keeps its pod spec.
+POD_SPEC_PATHS = {'Pod': ('spec',),
+                  'PodTemplate': ('template', 'spec'),
+                  'Deployment': ('spec', 'template', 'spec'),
+                  'StatefulSet': ('spec', 'template', 'spec'),
+                  'DaemonSet': ('spec', 'template', 'spec'),
+                  'ReplicaSet': ('spec', 'template', 'spec'),
+                  'ReplicationController': ('spec', 'template', 'spec'),
+                  'Job': ('spec', 'template', 'spec'),
+                  'CronJob': ('spec', 'jobTemplate', 'spec', 'template', 'spec')}
 
-def inject_variables(yaml_data, user):
-    def add_variables_to_spec(spec):
-        # Add environment variables.
-        for container in spec['containers']:
-            if 'env' not in container:
-                container['env'] = []
-            container['env'] += [{'name': ('knot_%s' % key).upper(), 'value': value} for key, value in user.local_data.items()]
+CONTAINER_LISTS = ('initContainers', 'containers', 'ephemeralContainers')
 
-    for part in yaml_data:
-        try:
-            if part['kind'] == 'Deployment':
-                spec = part['spec']['template']['spec']
-            elif part['kind'] == 'Pod':
-                spec = part['spec']
-            else:
-                continue
-        except:
-            continue
-        if not spec or 'containers' not in spec:
-            continue
-        add_variables_to_spec(spec)
+def locate_pod_spec(part):
+    ''' Return the JSON pointer to and contents of the pod spec in a workload, or (None, None). '''
+    try:
+        tokens = POD_SPEC_PATHS[part['kind']]
+        spec = part
+        for token in tokens:
+            spec = spec[token]
+    except:
+        return None, None
+    if not isinstance(spec, dict):
+        return None, None
+    return json_pointer(*tokens), spec
+
+def pod_containers(path, spec):
+    ''' Yield the JSON pointer to and contents of every container in a pod spec. '''
+    for key in CONTAINER_LISTS:
+        for i, container in enumerate(spec.get(key) or []):
+            yield path + json_pointer(key, i), container
+
+def append_patch(path, items, existing):
+    ''' Return JSONPatch operations that append items to the list at path (which may be missing). '''
+    if not items:
+        return []
+    if existing is None:
+        return [{'op': 'add', 'path': path, 'value': items}]
+    return [{'op': 'add', 'path': path + '/-', 'value': item} for item in items]
 
-def validate_hostpath_volumes(yaml_data, file_domains, other_allowed_paths=[]):
-    allowed_paths = [urlparse(file_domain.url).path for file_domain in file_domains.values() if file_domain.url.startswith('file://')]
-    allowed_paths += other_allowed_paths
+def inject_volumes(part, file_domains, pod_spec=None):
+    ''' Return JSONPatch operations that add and mount the file domain volumes (pass the located pod spec to avoid looking it up again). '''
+    path, spec = pod_spec or locate_pod_spec(part)
+    if not spec or 'containers' not in spec:
+        return []
+
+    # Add volumes.
+    existing_names = [v['name'] for v in spec.get('volumes') or []]
+    patch = append_patch(path + '/volumes',
+                         [{'name': file_domain.volume_name,
+                           'persistentVolumeClaim': {'claimName': file_domain.volume_name}} for file_domain in file_domains.values() if file_domain.volume_name not in existing_names],
+                         spec.get('volumes'))
+
+    # Mount volumes in containers.
+    for container_path, container in pod_containers(path, spec):
+        existing_names = [v['name'] for v in container.get('volumeMounts') or []]
+        patch += append_patch(container_path + '/volumeMounts',
+                              [{'name': file_domain.volume_name,
+                                'mountPath': file_domain.mount_dir} for file_domain in file_domains.values() if file_domain.volume_name not in existing_names],
+                              container.get('volumeMounts'))
+    return patch
+
+def inject_variables(part, user, pod_spec=None):
+    '''
+    Return JSONPatch operations that set the user's environment variables in all containers.
+    Variables already set to other values are replaced, so the injected values take precedence,
+    and those already injected (e.g., in a pod created from a mutated template) are left as is.
+    '''
+    path, spec = pod_spec or locate_pod_spec(part)
+    if not spec or 'containers' not in spec:
+        return []
+
+    # Add environment variables.
+    variables = [{'name': ('knot_%s' % key).upper(), 'value': value} for key, value in user.local_data.items()]
+    patch = []
+    for container_path, container in pod_containers(path, spec):
+        env = container.get('env') or []
+        existing = {v.get('name'): i for i, v in enumerate(env)}
+        missing = []
+        for variable in variables:
+            i = existing.get(variable['name'])
+            if i is None:
+                missing.append(variable)
+            elif env[i] != variable:
+                patch.append({'op': 'replace', 'path': container_path + json_pointer('env', i), 'value': variable})
+        patch += append_patch(container_path + '/env', missing, container.get('env'))
+    return patch
+
+def allowed_hostpaths(file_domains, other_allowed_paths=[]):
+    allowed_paths = set(urlparse(file_domain.url).path for file_domain in file_domains.values() if file_domain.url.startswith('file://'))
+    allowed_paths.update(other_allowed_paths)
+    return allowed_paths
+
+def validate_hostpath_volumes(yaml_data, file_domains, other_allowed_paths=[], allowed_paths=None):
+    if allowed_paths is None:
+        allowed_paths = allowed_hostpaths(file_domains, other_allowed_paths)
 
     for part in yaml_data:
-        try:
-            if part['kind'] == 'Deployment':
-                spec_volumes = part['spec']['template']['spec']['volumes']
-            elif part['kind'] == 'Pod':
-                spec_volumes = part['spec']['volumes']
-            else:
-                continue
-        except:
-            continue
+        _, spec = locate_pod_spec(part)
+        spec_volumes = spec.get('volumes') if spec else None
         if not spec_volumes:
             continue
         for volume in spec_volumes:
@@ -100,39 +130,44 @@ def validate_hostpath_volumes(yaml_data, file_domains, other_allowed_paths=[]):
 
     return True
 
-def inject_ingress_auth(yaml_data, auth_config, redirect_ssl=False):
-    for part in yaml_data:
-        if part.get('kind') == 'Ingress':
-            try:
-                if 'knot-no-auth' in part['metadata']['labels'].keys():
-                    return
-            except:
-                pass
-            if 'metadata' not in part:
-                part['metadata'] = {}
-            if 'annotations' not in part['metadata']:
-                part['metadata']['annotations'] = {}
-            if 'vouch_url' in auth_config:
-                part['metadata']['annotations']['nginx.ingress.kubernetes.io/auth-signin'] = '%s/login?url=$scheme://$http_host$request_uri&vouch-failcount=$auth_resp_failcount&X-Vouch-Token=$auth_resp_jwt&error=$auth_resp_err' % auth_config['vouch_url']
-                part['metadata']['annotations']['nginx.ingress.kubernetes.io/auth-url'] = '%s/validate' % auth_config['vouch_url']
-                part['metadata']['annotations']['nginx.ingress.kubernetes.io/auth-response-headers'] = 'X-Vouch-User'
-                part['metadata']['annotations']['nginx.ingress.kubernetes.io/auth-snippet'] = '\n'.join(('auth_request_set $auth_resp_jwt $upstream_http_x_vouch_jwt;',
-                                                                                                         'auth_request_set $auth_resp_err $upstream_http_x_vouch_err;',
-                                                                                                         'auth_request_set $auth_resp_failcount $upstream_http_x_vouch_failcount;'))
-                part['metadata']['annotations']['nginx.ingress.kubernetes.io/configuration-snippet'] = '\n'.join(('  auth_request_set $auth_resp_x_vouch_username $upstream_http_x_vouch_idp_claims_preferred_username;',
-                                                                                                                  '  access_by_lua_block {',
-                                                                                                                  '    if not (string.match(ngx.var.auth_resp_x_vouch_username, "%s")) then' % auth_config['username'],
-                                                                                                                  '      ngx.exit(ngx.HTTP_FORBIDDEN);',
-                                                                                                                  '    end',
-                                                                                                                  '  }'))
-
-            else:
-                # Fallback to basic HTTP authentication.
-                part['metadata']['annotations']['nginx.ingress.kubernetes.io/auth-type'] = 'basic'
-                part['metadata']['annotations']['nginx.ingress.kubernetes.io/auth-secret'] = auth_config['secret']
-                part['metadata']['annotations']['nginx.ingress.kubernetes.io/auth-realm'] = auth_config['realm']
-            if redirect_ssl:
-                part['metadata']['annotations']['nginx.ingress.kubernetes.io/force-ssl-redirect'] = 'true'
+def inject_ingress_auth(part, auth_config, redirect_ssl=False):
+    ''' Return JSONPatch operations that add authentication annotations to an Ingress. '''
+    if part.get('kind') != 'Ingress':
+        return []
+    try:
+        if 'knot-no-auth' in part['metadata']['labels'].keys():
+            return []
+    except:
+        pass
+
+    annotations = {}
+    if 'vouch_url' in auth_config:
+        annotations['nginx.ingress.kubernetes.io/auth-signin'] = '%s/login?url=$scheme://$http_host$request_uri&vouch-failcount=$auth_resp_failcount&X-Vouch-Token=$auth_resp_jwt&error=$auth_resp_err' % auth_config['vouch_url']
+        annotations['nginx.ingress.kubernetes.io/auth-url'] = '%s/validate' % auth_config['vouch_url']
+        annotations['nginx.ingress.kubernetes.io/auth-response-headers'] = 'X-Vouch-User'
+        annotations['nginx.ingress.kubernetes.io/auth-snippet'] = '\n'.join(('auth_request_set $auth_resp_jwt $upstream_http_x_vouch_jwt;',
+                                                                             'auth_request_set $auth_resp_err $upstream_http_x_vouch_err;',
+                                                                             'auth_request_set $auth_resp_failcount $upstream_http_x_vouch_failcount;'))
+        annotations['nginx.ingress.kubernetes.io/configuration-snippet'] = '\n'.join(('  auth_request_set $auth_resp_x_vouch_username $upstream_http_x_vouch_idp_claims_preferred_username;',
+                                                                                      '  access_by_lua_block {',
+                                                                                      '    if not (string.match(ngx.var.auth_resp_x_vouch_username, "%s")) then' % auth_config['username'],
+                                                                                      '      ngx.exit(ngx.HTTP_FORBIDDEN);',
+                                                                                      '    end',
+                                                                                      '  }'))
+
+    else:
+        # Fallback to basic HTTP authentication.
+        annotations['nginx.ingress.kubernetes.io/auth-type'] = 'basic'
+        annotations['nginx.ingress.kubernetes.io/auth-secret'] = auth_config['secret']
+        annotations['nginx.ingress.kubernetes.io/auth-realm'] = auth_config['realm']
+    if redirect_ssl:
+        annotations['nginx.ingress.kubernetes.io/force-ssl-redirect'] = 'true'
+
+    if not part.get('metadata'):
+        return [{'op': 'add', 'path': json_pointer('metadata'), 'value': {'annotations': annotations}}]
+    if not part['metadata'].get('annotations'):
+        return [{'op': 'add', 'path': json_pointer('metadata', 'annotations'), 'value': annotations}]
+    return [{'op': 'add', 'path': json_pointer('metadata', 'annotations', key), 'value': value} for key, value in annotations.items()]
 
 def validate_ingress_host(yaml_data, username, ingress_host):
     for part in yaml_data:
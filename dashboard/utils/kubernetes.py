@@ -12,16 +12,39 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os
-import tempfile
+import json
+import base64
+import hashlib
+import threading
 
 import kubernetes.client
 import kubernetes.config
+import kubernetes.dynamic
 import kubernetes.stream
 
 from urllib.parse import urlparse
+from ruamel.yaml import YAML
 
 
+FIELD_MANAGER = 'knot'
+SECRET_HASH_ANNOTATION = 'knot/content-hash'
+SECRET_UPDATE_ATTEMPTS = 5
+
+_dynamic_client = None
+_dynamic_client_lock = threading.Lock()
+
+def load_yaml_documents(yaml_data):
+    return [document for document in YAML(typ='safe').load_all(yaml_data) if document]
+
+def ignore_not_found(func, *args, **kwargs):
+    ''' Call func, treating "Not Found" as success (for deletions). '''
+    try:
+        return func(*args, **kwargs)
+    except kubernetes.client.exceptions.ApiException as e: # Dynamic client errors are subclasses.
+        if e.status != 404:
+            raise
+        return None
+
 class KubernetesClient(object):
     def __init__(self):
         self._config_loaded = False
@@ -59,10 +82,32 @@ class KubernetesClient(object):
             self._custom_objects_client = kubernetes.client.CustomObjectsApi()
         return self._custom_objects_client
 
+    @property
+    def dynamic_client(self):
+        ''' Shared by all instances, so that API discovery is done once per process. '''
+        global _dynamic_client
+        with _dynamic_client_lock:
+            if not _dynamic_client:
+                self._load_config()
+                _dynamic_client = kubernetes.dynamic.DynamicClient(kubernetes.client.ApiClient())
+        return _dynamic_client
+
     @property
     def host(self):
         return self.core_client.api_client.configuration.host
 
+    def get_namespace(self, name):
+        return ignore_not_found(self.core_client.read_namespace, name)
+
+    def get_service_account(self, namespace, name):
+        return ignore_not_found(self.core_client.read_namespaced_service_account, name, namespace)
+
+    def get_secret(self, namespace, name):
+        return ignore_not_found(self.core_client.read_namespaced_secret, name, namespace)
+
+    def get_persistent_volume_claim(self, namespace, name):
+        return ignore_not_found(self.core_client.read_namespaced_persistent_volume_claim, name, namespace)
+
     def list_namespaces(self):
         return self.core_client.list_namespace().items
 
@@ -81,39 +126,43 @@ class KubernetesClient(object):
     def list_crds(self, group, version, namespace, plural):
         return self.custom_objects_client.list_namespaced_custom_object(group=group, version=version, namespace=namespace, plural=plural)['items']
 
-    def list_secrets(self, namespace):
-        return self.core_client.list_namespaced_secret(namespace=namespace).items
+    def list_secrets(self, namespace, label_selector=None):
+        return self.core_client.list_namespaced_secret(namespace=namespace, label_selector=label_selector).items
 
     def list_persistent_volume_claims(self, namespace):
         return self.core_client.list_namespaced_persistent_volume_claim(namespace=namespace).items
 
+    def _resource_namespace(self, resource, document, namespace):
+        if not resource.namespaced:
+            return None
+        return document.get('metadata', {}).get('namespace') or namespace or 'default'
+
     def apply_yaml_file(self, yaml_file, namespace=None):
-        command = 'kubectl apply -f %s' % yaml_file
-        if namespace:
-            command += ' -n %s' % namespace
-        # if os.system(command) != 0:
-        #     raise SystemError('Can not apply service file')
-        os.system(command)
+        with open(yaml_file, 'rb') as f:
+            self.apply_yaml_data(f.read(), namespace)
 
     def apply_yaml_data(self, yaml_data, namespace=None):
-        with tempfile.NamedTemporaryFile() as f:
-            f.write(yaml_data)
-            f.seek(0)
-            self.apply_yaml_file(f.name, namespace)
+        ''' Create or update all objects in a (multi-document) YAML with server-side apply. '''
+        for document in load_yaml_documents(yaml_data):
+            resource = self.dynamic_client.resources.get(api_version=document['apiVersion'], kind=document['kind'])
+            self.dynamic_client.server_side_apply(resource,
+                                                  body=document,
+                                                  namespace=self._resource_namespace(resource, document, namespace),
+                                                  field_manager=FIELD_MANAGER,
+                                                  force_conflicts=True)
 
     def delete_yaml_file(self, yaml_file, namespace=None):
-        command = 'kubectl delete -f %s' % yaml_file
-        if namespace:
-            command += ' -n %s' % namespace
-        # if os.system(command) != 0:
-        #     raise SystemError('Can not delete service file')
-        os.system(command)
+        with open(yaml_file, 'rb') as f:
+            self.delete_yaml_data(f.read(), namespace)
 
     def delete_yaml_data(self, yaml_data, namespace=None):
-        with tempfile.NamedTemporaryFile() as f:
-            f.write(yaml_data)
-            f.seek(0)
-            self.delete_yaml_file(f.name, namespace)
+        ''' Delete all objects in a (multi-document) YAML, ignoring the ones already gone. '''
+        for document in reversed(load_yaml_documents(yaml_data)):
+            resource = self.dynamic_client.resources.get(api_version=document['apiVersion'], kind=document['kind'])
+            ignore_not_found(self.dynamic_client.delete,
+                             resource,
+                             name=document['metadata']['name'],
+                             namespace=self._resource_namespace(resource, document, namespace))
 
     def apply_crd(self, group, version, namespace, plural, yaml):
         return self.custom_objects_client.create_namespaced_custom_object(group=group, version=version, namespace=namespace, plural=plural, body=yaml)
@@ -122,23 +171,62 @@ class KubernetesClient(object):
         return self.custom_objects_client.delete_namespaced_custom_object(group=group, version=version, namespace=namespace, plural=plural, name=name, body={})
 
     def delete_secret(self, namespace, name):
-        command = 'kubectl delete secret %s' % name
-        if namespace:
-            command += ' -n %s' % namespace
-        # if os.system(command) != 0:
-        #     raise SystemError('Can not delete secret')
-        os.system(command)
+        ignore_not_found(self.core_client.delete_namespaced_secret, name, namespace)
+
+    def upsert_secret(self, namespace, name, data, secret_type='Opaque'):
+        '''
+        Create or replace a secret in place, so it never goes missing. Replacements are
+        conditional on the resourceVersion read (retrying on conflicts), and skipped
+        if the content hash matches. Return True if the secret was written. If conflicts
+        persist, the last one is raised.
+        '''
+
+        encoded_data = {k: base64.b64encode(v.encode()).decode() for k, v in data.items()}
+        content_hash = hashlib.sha256(json.dumps([secret_type, encoded_data], sort_keys=True).encode()).hexdigest()
+
+        conflict = None
+        for attempt in range(SECRET_UPDATE_ATTEMPTS):
+            secret = self.get_secret(namespace, name)
+            if secret and secret.type != secret_type:
+                # The type can not be changed in place.
+                self.delete_secret(namespace, name)
+                secret = None
+            if not secret:
+                body = kubernetes.client.V1Secret(metadata=kubernetes.client.V1ObjectMeta(name=name,
+                                                                                          annotations={SECRET_HASH_ANNOTATION: content_hash}),
+                                                  type=secret_type,
+                                                  data=encoded_data)
+                try:
+                    self.core_client.create_namespaced_secret(namespace, body)
+                except kubernetes.client.exceptions.ApiException as e:
+                    if e.status == 409: # Created meanwhile.
+                        conflict = e
+                        continue
+                    raise
+                return True
+
+            annotations = dict(secret.metadata.annotations or {})
+            if annotations.get(SECRET_HASH_ANNOTATION) == content_hash and secret.data == encoded_data:
+                return False
+            annotations[SECRET_HASH_ANNOTATION] = content_hash
+            body = kubernetes.client.V1Secret(metadata=kubernetes.client.V1ObjectMeta(name=name,
+                                                                                      labels=secret.metadata.labels,
+                                                                                      annotations=annotations,
+                                                                                      resource_version=secret.metadata.resource_version),
+                                              type=secret_type,
+                                              data=encoded_data)
+            try:
+                self.core_client.replace_namespaced_secret(name, namespace, body)
+            except kubernetes.client.exceptions.ApiException as e:
+                if e.status in (404, 409): # Deleted or changed meanwhile.
+                    conflict = e
+                    continue
+                raise
+            return True
+        raise conflict
 
     def update_secret(self, namespace, name, literals):
-        self.delete_secret(namespace, name)
-        command = 'kubectl create secret generic %s' % name
-        if namespace:
-            command += ' -n %s' % namespace
-        for literal in literals:
-            command += ' --from-literal=\'%s\'' % literal
-        # if os.system(command) != 0:
-        #     raise SystemError('Can not create secret')
-        os.system(command)
+        self.upsert_secret(namespace, name, dict(literal.split('=', 1) for literal in literals))
 
     def update_registry_secret(self, namespace, registry_url, email):
         if not registry_url:
@@ -148,12 +236,17 @@ class KubernetesClient(object):
         if not url.username or not url.password:
             return
 
-        if 'docker-registry-secret' not in [s.metadata.name for s in self.list_secrets(namespace)]:
-            os.system('kubectl patch serviceaccount default -n %s -p \'{"imagePullSecrets": [{"name": "docker-registry-secret"}]}\'' % namespace)
+        if not self.get_secret(namespace, 'docker-registry-secret'):
+            body = {'imagePullSecrets': [{'name': 'docker-registry-secret'}]}
+            self.core_client.patch_namespaced_service_account('default', namespace, body)
 
-        self.delete_secret(namespace, 'docker-registry-secret')
         server = '%s://' % url.scheme + ('%s:%s' % (url.hostname, url.port) if url.port else url.hostname)
-        os.system('kubectl create secret docker-registry docker-registry-secret -n %s --docker-server="%s" --docker-username="%s" --docker-password="%s" --docker-email="%s"' % (namespace, server, url.username, url.password, email))
+        auth = base64.b64encode(('%s:%s' % (url.username, url.password)).encode()).decode()
+        docker_config = {'auths': {server: {'username': url.username,
+                                            'password': url.password,
+                                            'email': email,
+                                            'auth': auth}}}
+        self.upsert_secret(namespace, 'docker-registry-secret', {'.dockerconfigjson': json.dumps(docker_config)}, secret_type='kubernetes.io/dockerconfigjson')
 
     def exec_command_in_pod(self, namespace, label_selector, command, all_pods=False):
         result = []
@@ -180,3 +273,37 @@ class KubernetesClient(object):
             self.core_client.patch_namespace(namespace, body)
         except:
             pass
+
+class PrefetchedKubernetesClient(KubernetesClient):
+    '''
+    Answers lookups for namespaces, volume claims, and service accounts from lists
+    fetched once with prefetch(), for provisioning many users in a row. Objects
+    created afterwards are not seen, so this is only meant for existence checks.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self._namespaces = None
+        self._persistent_volume_claims = None
+        self._service_accounts = {}
+
+    def prefetch(self, service_account_namespaces=()):
+        self._namespaces = {n.metadata.name: n for n in self.core_client.list_namespace().items}
+        self._persistent_volume_claims = {(pvc.metadata.namespace, pvc.metadata.name): pvc for pvc in self.core_client.list_persistent_volume_claim_for_all_namespaces().items}
+        for namespace in service_account_namespaces:
+            self._service_accounts[namespace] = {s.metadata.name: s for s in self.list_service_accounts(namespace)}
+
+    def get_namespace(self, name):
+        if self._namespaces is None:
+            return super().get_namespace(name)
+        return self._namespaces.get(name)
+
+    def get_persistent_volume_claim(self, namespace, name):
+        if self._persistent_volume_claims is None:
+            return super().get_persistent_volume_claim(namespace, name)
+        return self._persistent_volume_claims.get((namespace, name))
+
+    def get_service_account(self, namespace, name):
+        if namespace not in self._service_accounts:
+            return super().get_service_account(namespace, name)
+        return self._service_accounts[namespace].get(name)
@@ -0,0 +1,90 @@
+# Copyright [2019] [FORTH-ICS]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+
+# Metrics are kept per process and exported in the Prometheus text format.
+_registry = []
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, v) for k, v in labels.items())
+
+class Counter(object):
+    metric_type = 'counter'
+
+    def __init__(self, name, description, labels=None):
+        self.name = name
+        self.description = description
+        self.labels = labels or {}
+        self._lock = threading.Lock()
+        self._value = 0
+        _registry.append(self)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def samples(self):
+        return [(self.name + format_labels(self.labels), self._value)]
+
+class Gauge(Counter):
+    metric_type = 'gauge'
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+class Histogram(object):
+    metric_type = 'histogram'
+
+    def __init__(self, name, description, labels=None, buckets=(.001, .005, .01, .05, .1, .5, 1, 5)):
+        self.name = name
+        self.description = description
+        self.labels = labels or {}
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._count = 0
+        self._sum = 0
+        _registry.append(self)
+
+    def observe(self, value):
+        with self._lock:
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+            self._count += 1
+            self._sum += value
+
+    def samples(self):
+        with self._lock:
+            samples = [('%s_bucket%s' % (self.name, format_labels(dict(self.labels, le=bound))), count) for bound, count in zip(self._buckets, self._counts)]
+            samples += [('%s_bucket%s' % (self.name, format_labels(dict(self.labels, le='+Inf'))), self._count),
+                        ('%s_sum%s' % (self.name, format_labels(self.labels)), self._sum),
+                        ('%s_count%s' % (self.name, format_labels(self.labels)), self._count)]
+        return samples
+
+def render_metrics():
+    # Metrics with the same name (and different labels) share a description.
+    lines = []
+    described = set()
+    for metric in sorted(_registry, key=lambda m: m.name):
+        if metric.name not in described:
+            lines.append('# HELP %s %s' % (metric.name, metric.description))
+            lines.append('# TYPE %s %s' % (metric.name, metric.metric_type))
+            described.add(metric.name)
+        lines += ['%s %s' % sample for sample in metric.samples()]
+    return '\n'.join(lines) + '\n'
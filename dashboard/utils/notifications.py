@@ -0,0 +1,106 @@
+# Copyright [2019] [FORTH-ICS]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import atexit
+import asyncio
+import logging
+import threading
+
+from django.conf import settings
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+
+
+FLUSH_TIMEOUT = 5
+
+logger = logging.getLogger(__name__)
+
+class NotificationDispatcher(object):
+    '''
+    Collects updates for channel groups and sends them in batches, after a short
+    delay, from an event loop kept running in a background thread. Within a batch,
+    updates for the same task replace each other and duplicate updates are dropped.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pid = None
+        self._loop = None
+        self._scheduled = False
+
+    def _start(self):
+        # Called with the lock held. Restart in forked children, as the thread is not inherited.
+        if self._loop and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._pending = {}
+        self._scheduled = False
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+
+    def _key(self, message, data):
+        if data.get('task_id'):
+            return (message, data['task_id'])
+        return (message, json.dumps(data, sort_keys=True, default=str))
+
+    def send(self, group, message, data=None):
+        update = {'message': message, 'data': data or {}, 'sent': time.time()}
+        if not settings.NOTIFICATION_DELAY:
+            async_to_sync(get_channel_layer().group_send)(group, dict(update, type='update_message'))
+            return
+
+        key = self._key(message, update['data'])
+        with self._lock:
+            self._start()
+            updates = self._pending.setdefault(group, {})
+            updates.pop(key, None) # Keep the latest at the end.
+            updates[key] = update
+            if not self._scheduled:
+                self._scheduled = True
+                asyncio.run_coroutine_threadsafe(self._flush(settings.NOTIFICATION_DELAY), self._loop)
+
+    async def _flush(self, delay=0):
+        if delay:
+            await asyncio.sleep(delay)
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._scheduled = False
+        if not pending:
+            return
+
+        # The channel layer publishes per group, so send all groups concurrently.
+        channel_layer = get_channel_layer()
+        groups = list(pending.keys())
+        results = await asyncio.gather(*[channel_layer.group_send(group, {'type': 'update_messages', 'messages': list(pending[group].values())})
+                                         for group in groups],
+                                       return_exceptions=True)
+        for group, result in zip(groups, results):
+            if isinstance(result, BaseException):
+                logger.error('Can not send %d updates to %s: %r', len(pending[group]), group, result)
+
+    def flush(self):
+        with self._lock:
+            if not self._loop or self._pid != os.getpid() or not self._pending:
+                return
+        try:
+            asyncio.run_coroutine_threadsafe(self._flush(), self._loop).result(FLUSH_TIMEOUT)
+        except:
+            pass
+
+notification_dispatcher = NotificationDispatcher()
+atexit.register(notification_dispatcher.flush)
@@ -0,0 +1,46 @@
+# Copyright [2019] [FORTH-ICS]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from celery import current_app, states
+
+
+def get_task_metas(task_ids):
+    '''
+    Return the Celery result metadata (with "status" and "result") for each task id.
+    Key-value backends (like Redis) are asked for all tasks in a single MGET; other
+    backends fall back to one lookup per task.
+    '''
+
+    if not task_ids:
+        return {}
+
+    backend = current_app.backend
+    try:
+        keys = [backend.get_key_for_task(task_id) for task_id in task_ids]
+        values = backend.mget(keys)
+    except (AttributeError, NotImplementedError):
+        return {task_id: backend.get_task_meta(task_id) for task_id in task_ids}
+    if hasattr(values, 'items'):
+        values = [values.get(key) for key in keys]
+
+    metas = {}
+    for task_id, value in zip(task_ids, values):
+        meta = None
+        if value:
+            try:
+                meta = backend.decode_result(value)
+            except:
+                pass
+        metas[task_id] = meta or {'status': states.PENDING, 'result': None}
+    return metas
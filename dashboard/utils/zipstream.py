@@ -0,0 +1,84 @@
+# Copyright [2019] [FORTH-ICS]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import stat
+import zipfile
+
+
+CHUNK_SIZE = 1024 * 1024
+
+# Files that are not worth compressing again.
+COMPRESSED_EXTENSIONS = ('.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', '.jar', '.whl',
+                         '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.avi', '.mov',
+                         '.pdf', '.parquet', '.h5', '.npz')
+
+class ZipStreamBuffer(object):
+    '''
+    Write-only, unseekable file object for ZipFile, holding what has been written
+    until it is drained. ZipFile then uses data descriptors instead of seeking back.
+    '''
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+def stream_zip(path, compress=True):
+    '''
+    Yield a ZIP archive of the directory at path (with entries relative to its parent)
+    in chunks, holding at most about one chunk in memory. Large archives and files use
+    ZIP64. Without compress, or for already compressed files, entries are stored.
+    '''
+
+    buffer = ZipStreamBuffer()
+    parent_path = os.path.dirname(path)
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED) as zip_file:
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                file_path = os.path.join(root, file)
+                try:
+                    zip_info = zipfile.ZipInfo.from_file(file_path, file_path[len(parent_path):])
+                    if not stat.S_ISREG(zip_info.external_attr >> 16):
+                        continue
+                    f = open(file_path, 'rb')
+                except OSError:
+                    continue
+                if not compress or file.lower().endswith(COMPRESSED_EXTENSIONS):
+                    zip_info.compress_type = zipfile.ZIP_STORED
+                else:
+                    zip_info.compress_type = zipfile.ZIP_DEFLATED
+                with f, zip_file.open(zip_info, 'w') as zip_entry:
+                    while True:
+                        data = f.read(CHUNK_SIZE)
+                        if not data:
+                            break
+                        zip_entry.write(data)
+                        yield from buffer.drain()
+                yield from buffer.drain()
+    yield from buffer.drain()
@@ -14,25 +14,85 @@
 
 import os
 import re
+import hmac
+import uuid
 
 from django.shortcuts import render, redirect, reverse
-from django.http import HttpResponse, FileResponse
+from django.http import HttpResponse, StreamingHttpResponse, JsonResponse
 from django.conf import settings
 from django.contrib.auth import logout as auth_logout, update_session_auth_hash
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import SetPasswordForm, PasswordChangeForm
 from django.contrib.admin.views.decorators import staff_member_required
-from chunked_upload.views import ChunkedUploadView, ChunkedUploadCompleteView
-from celery.result import AsyncResult
 from packaging import version
 
-from .models import User, Profile, Membership, Message, Task
+from .models import User, Profile, Membership, Message, Task, Upload, DirectoryIndex
 from .forms import SignUpForm, EditUserForm, AddServiceForm, CreateServiceForm, ShowServiceForm, AddFolderForm, AddImageFromFileForm, CreateTeamForm, EditTeamForm
 from .services import ServiceTemplateManager, ServiceManager
 from .utils.kubernetes import KubernetesClient
-from .tasks import create_service_task
+from .utils.task_status import get_task_metas
+from .utils.metrics import render_metrics
+from .utils.downloads import file_response
+from .utils.file_domains.file import PARTIAL_UPLOAD_PREFIX
+from .tasks import create_service_task, delete_service_task, finalize_upload_task
 
 
+SERVICE_TASK_NAMES = ('create_service', 'delete_service')
+
+def enqueue_service_task(user, name, task, args, release, **data):
+    # Record the task and announce it before it can run, so "queued" never follows its outcome.
+    task_id = str(uuid.uuid4())
+    Task.add(user, name, task_id)
+    try:
+        user.send_update(name, task_id=task_id, state='queued', release=release, **data)
+    except:
+        pass
+    task.apply_async(args, task_id=task_id)
+    return task_id
+
+def collect_service_tasks(request, task_ids=None, flash=True):
+    '''
+    Return pending service tasks. Finished ones are turned into messages
+    and removed, all with one result backend lookup and one delete query.
+    '''
+
+    tasks = []
+    finished_tasks = []
+    user_tasks = request.user.tasks.filter(name__in=SERVICE_TASK_NAMES)
+    if task_ids is not None:
+        user_tasks = user_tasks.filter(task_id__in=task_ids)
+    user_tasks = list(user_tasks)
+    task_metas = get_task_metas([task.task_id for task in user_tasks])
+    for task in user_tasks:
+        task_meta = task_metas[task.task_id]
+        if task_meta['status'] == 'STARTED' or task_meta['status'] == 'PENDING':
+            tasks.append(task)
+            continue
+
+        if task_meta['status'] == 'SUCCESS':
+            level, message = 'success', str(task_meta['result'])
+        elif task_meta['status'] == 'FAILURE':
+            level, message = 'error', str(task_meta['result'])
+        else:
+            level = None
+        if level and flash:
+            Message.add(request, level, message)
+        elif level:
+            Message.objects.create(user=request.user, level=level, message=message)
+        # Delete done and revoked.
+        finished_tasks.append(task.pk)
+    if finished_tasks:
+        Task.objects.filter(pk__in=finished_tasks).delete()
+
+    return tasks
+
+def metrics(request):
+    # Counters are per process, so this reports on whichever server handles the request.
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not settings.METRICS_TOKEN or not hmac.compare_digest(authorization.encode(), ('Bearer %s' % settings.METRICS_TOKEN).encode()):
+        return HttpResponse('Unauthorized', status=401, content_type='text/plain')
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4')
+
 @login_required
 def dashboard(request):
     return redirect('services')
@@ -55,12 +115,7 @@ def services(request):
         elif request.POST['action'] == 'Remove':
             name = request.POST.get('service', None)
             if name:
-                try:
-                    service_manager.delete(name)
-                except Exception as e:
-                    Message.add(request, 'error', 'Can not remove service "%s": %s' % (name, str(e)))
-                else:
-                    Message.add(request, 'success', 'Service "%s" removed.' % name)
+                enqueue_service_task(request.user, 'delete_service', delete_service_task, (request.user.pk, name), name)
         else:
             Message.add(request, 'error', 'Invalid action.')
 
@@ -96,33 +151,39 @@ def services(request):
     except:
         templates = None
     if templates:
+        template_versions = {template['name']: template['version'] for template in templates}
         for service in contents:
             service['upgradeable'] = False
-            current_version = next((template['version'] for template in templates if template['name'] == service['chart']), None)
+            current_version = template_versions.get(service['chart'])
             if current_version and version.parse(current_version) > version.parse(service['version']):
                 service['upgradeable'] = True
 
     # Get pending tasks.
-    tasks = []
-    for task in request.user.tasks.filter(name='create_service'):
-        task_result = AsyncResult(task.task_id)
-        if task_result.status == 'STARTED' or task_result.status == 'PENDING':
-            tasks.append(task)
-            continue
-
-        if task_result.status == 'SUCCESS':
-            Message.add(request, 'success', task_result.result)
-        elif task_result.status == 'FAILURE':
-            Message.add(request, 'error', str(task_result.result))
-        # Delete done and revoked.
-        task.delete()
+    tasks = collect_service_tasks(request)
 
     return render(request, 'dashboard/services.html', {'title': 'Services',
                                                        'contents': contents,
                                                        'sort_by': sort_by,
                                                        'order': order,
                                                        'add_service_form': AddServiceForm(user=request.user),
-                                                       'tasks': tasks})
+                                                       'tasks': tasks,
+                                                       'pending_tasks': {task.task_id: task.name for task in tasks},
+                                                       'create_tasks': [task for task in tasks if task.name == 'create_service'],
+                                                       'delete_tasks': [task for task in tasks if task.name == 'delete_service']})
+
+@login_required
+def service_tasks(request):
+    # Finished tasks acknowledged by the page are only recorded in messages.
+    if request.method == 'POST':
+        collect_service_tasks(request, task_ids=request.POST.getlist('task'), flash=False)
+        return JsonResponse({})
+
+    user_tasks = list(request.user.tasks.filter(name__in=SERVICE_TASK_NAMES).order_by('created'))
+    task_metas = get_task_metas([task.task_id for task in user_tasks])
+    return JsonResponse({'tasks': [{'id': task.task_id,
+                                    'name': task.name,
+                                    'status': task_metas[task.task_id]['status'].lower(),
+                                    'created': task.created.isoformat()} for task in user_tasks]})
 
 @login_required
 def service_info(request, name=''):
@@ -169,8 +230,7 @@ def service_create(request, name=''):
         form = CreateServiceForm(request.POST, variables=variables)
         if form.is_valid():
             data = request.POST.dict()
-            task_result = create_service_task.apply_async((request.user.pk, name, variables, data))
-            Task.add(request.user, 'create_service', task_result.task_id)
+            enqueue_service_task(request.user, 'create_service', create_service_task, (request.user.pk, name, variables, data), data.get('name'))
             return redirect('services')
     else:
         form = CreateServiceForm(variables=variables)
@@ -202,8 +262,11 @@ def service_upgrade(request, name=''):
         return redirect('services')
 
     # Replace default values with current values.
+    current_values = {}
+    for v in current_variables:
+        current_values.setdefault((v['label'], v['type']), v['default'])
     for variable in default_variables:
-        current_value = next((v['default'] for v in current_variables if (v['label'] == variable['label'] and v['type'] == variable['type'])), None)
+        current_value = current_values.get((variable['label'], variable['type']))
         if current_value:
             variable['default'] = current_value
 
@@ -212,8 +275,7 @@ def service_upgrade(request, name=''):
         form = CreateServiceForm(request.POST, variables=default_variables)
         if form.is_valid():
             data = request.POST.dict()
-            task_result = create_service_task.apply_async((request.user.pk, service['chart'], default_variables, data, True))
-            Task.add(request.user, 'create_service', task_result.task_id)
+            enqueue_service_task(request.user, 'create_service', create_service_task, (request.user.pk, service['chart'], default_variables, data, True), name, upgrade=True)
             return redirect('services')
         pass
     else:
@@ -298,8 +360,7 @@ def files(request, path='/'):
             if not path_worker.isdir(name):
                 Message.add(request, 'error', 'Can not download "%s".' % name)
             else:
-                response = HttpResponse(content_type='application/zip')
-                path_worker.download(name, response)
+                response = StreamingHttpResponse(path_worker.download(name, compress=settings.FILES_ZIP_COMPRESSION), content_type='application/zip')
                 response['Content-Disposition'] = 'attachment; filename="%s.zip"' % re.sub(r'[^A-Za-z0-9 \-_]+', '', name)
                 return response
         elif request.POST['action'] == 'Delete':
@@ -328,7 +389,7 @@ def files(request, path='/'):
         request.session['files_path'] = os.path.dirname(path) # Save path to folder.
         parent_path_worker = file_domains[path_components[0]].path_worker(path_components[1:-1])
         name = path_components[-1]
-        return FileResponse(parent_path_worker.open(name, 'rb'), as_attachment=True, filename=name)
+        return file_response(request, parent_path_worker.path_of(name), name)
     if not path_worker.isdir():
         request.session.pop('files_path', None)
         # Message.add(request, 'error', 'Invalid path.')
@@ -342,12 +403,7 @@ def files(request, path='/'):
         trail.append({'name': path_component,
                       'url': reverse('files', args=[os.path.join(*path_components[:i + 2])]) if i != (len(path_components) - 2) else None})
 
-    # Fill in the contents.
-    contents = path_worker.listdir()
-    for content in contents:
-        content.update({'url': reverse('files', args=[os.path.join(path, content['name'])])})
-
-    # Sort them up.
+    # Sort order (the page fetches the contents in batches).
     sort_by = request.GET.get('sort_by')
     if sort_by and sort_by in ('name', 'modified', 'size'):
         request.session['files_sort_by'] = sort_by
@@ -359,47 +415,135 @@ def files(request, path='/'):
     else:
         order = request.session.get('files_order', 'asc')
 
-    contents = sorted(contents,
-                      key=lambda x: x[sort_by],
-                      reverse=True if order == 'desc' else False)
-
     return render(request, 'dashboard/files.html', {'title': 'Files',
                                                     'domain': domain,
                                                     'path': os.path.join(*path_components[1:]) if path_components[1:] else '',
                                                     'trail': trail,
-                                                    'contents': contents,
+                                                    'list_url': reverse('files_list', args=['/'.join(path_components)]),
                                                     'sort_by': sort_by,
                                                     'order': order,
+                                                    'upload_parallel_chunks': settings.FILES_UPLOAD_PARALLEL_CHUNKS,
                                                     'add_folder_form': AddFolderForm(),
                                                     'add_image_from_file_form': AddImageFromFileForm()})
 
-class UploadView(ChunkedUploadView):
-    pass
-
-class UploadCompleteView(ChunkedUploadCompleteView):
-    do_md5_check = False
-
-    def on_completion(self, uploaded_file, request):
-        '''
-        Placeholder method to define what to do when upload is complete.
-        '''
-
-        # Get user file domains.
-        path_worker = request.user.file_domains[request.POST['domain']].path_worker(request.POST['path'].split('/'))
-        if path_worker.exists(uploaded_file.name):
-            Message.add(request, 'error', 'Can not upload "%s". An item with the same name already exists.' % uploaded_file.name)
-            return
-        filename = os.path.join(settings.MEDIA_ROOT, uploaded_file.file.name)
-        path_worker.upload(filename, uploaded_file.name)
-
-    def get_response_data(self, chunked_upload, request):
-        '''
-        Data for the response. Should return a dictionary-like object.
-        Called *only* if POST is successful.
-        '''
-        filename = os.path.join(settings.MEDIA_ROOT, chunked_upload.file.name)
-        chunked_upload.delete(delete_file=os.path.exists(filename))
-        return {}
+@login_required
+def files_list(request, path='/'):
+    # Resolve the directory.
+    file_domains = request.user.file_domains
+    path = os.path.normpath(path).lstrip('/')
+    path_components = [p for p in path.split('/') if p]
+    if not path_components or path_components[0] not in file_domains.keys():
+        return JsonResponse({'error': 'Invalid path.'}, status=404)
+    path_worker = file_domains[path_components[0]].path_worker(path_components[1:])
+    if not path_worker.isdir():
+        return JsonResponse({'error': 'Invalid path.'}, status=404)
+
+    sort_by = request.GET.get('sort_by', 'name')
+    order = request.GET.get('order', 'asc')
+    if sort_by not in ('name', 'modified', 'size') or order not in ('asc', 'desc'):
+        return JsonResponse({'error': 'Invalid order.'}, status=400)
+    try:
+        limit = min(int(request.GET.get('limit', settings.FILES_PAGE_SIZE)), settings.FILES_PAGE_SIZE)
+        contents, cursor = path_worker.listdir_page(sort_by, order,
+                                                    limit=max(limit, 1),
+                                                    cursor=request.GET.get('cursor'),
+                                                    prefix=request.GET.get('prefix'),
+                                                    dir_sizes=DirectoryIndex.sizes(path_worker.real_path))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor or limit.'}, status=400)
+
+    return JsonResponse({'contents': [{'name': content['name'],
+                                       'type': content['type'],
+                                       'size': content['size'],
+                                       'files': content.get('files'),
+                                       'modified': content['modified'].isoformat(),
+                                       'url': reverse('files', args=[os.path.join(path, content['name'])])} for content in contents],
+                         'cursor': cursor})
+
+@login_required
+def files_upload(request):
+    ''' Start an upload, writing chunks straight into a file next to the destination. '''
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid method.'}, status=405)
+
+    file_domains = request.user.file_domains
+    domain = request.POST.get('domain')
+    path = request.POST.get('path', '')
+    filename = os.path.basename(request.POST.get('filename', ''))
+    try:
+        size = int(request.POST['size'])
+    except:
+        size = -1
+    if domain not in file_domains.keys() or filename in ('', '.', '..') or filename.startswith(PARTIAL_UPLOAD_PREFIX) or size < 0:
+        return JsonResponse({'error': 'Invalid upload.'}, status=400)
+    path_worker = file_domains[domain].path_worker([p for p in path.split('/') if p])
+    try:
+        if not path_worker.isdir():
+            raise ValueError
+    except:
+        return JsonResponse({'error': 'Invalid path.'}, status=404)
+    if path_worker.exists(filename):
+        error = 'Can not upload "%s". An item with the same name already exists.' % filename
+        Message.add(request, 'error', error)
+        return JsonResponse({'error': error}, status=409)
+
+    upload = Upload(user=request.user, domain=domain, path=path, filename=filename, size=size, chunk_size=settings.FILES_UPLOAD_CHUNK_SIZE)
+    path_worker.create_partial(upload.upload_id, size)
+    upload.save()
+    return JsonResponse({'upload_id': upload.upload_id,
+                         'chunk_size': upload.chunk_size})
+
+@login_required
+def files_upload_chunk(request, upload_id):
+    ''' Write the request body at the given offset (chunks can be sent concurrently). '''
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid method.'}, status=405)
+    try:
+        upload = request.user.uploads.get(upload_id=upload_id)
+    except Upload.DoesNotExist:
+        return JsonResponse({'error': 'Invalid upload.'}, status=404)
+
+    # Only whole chunks are accepted, so that completion can be tracked per chunk.
+    try:
+        offset = int(request.GET['offset'])
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+        index, remainder = divmod(offset, upload.chunk_size)
+    except:
+        return JsonResponse({'error': 'Invalid chunk.'}, status=400)
+    if offset < 0 or remainder or index >= upload.chunk_count or length != upload.chunk_length(index):
+        return JsonResponse({'error': 'Invalid chunk.'}, status=400)
+
+    written = upload.path_worker.write_partial(upload.upload_id, offset, iter(lambda: request.read(1024 * 1024), b''))
+    if written != length:
+        return JsonResponse({'error': 'Incomplete chunk.'}, status=400)
+    upload.add_chunk(index)
+    return JsonResponse({})
+
+@login_required
+def files_upload_complete(request, upload_id):
+    ''' Move the file in place, in the background if it is large. '''
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid method.'}, status=405)
+    try:
+        upload = request.user.uploads.get(upload_id=upload_id)
+    except Upload.DoesNotExist:
+        return JsonResponse({'error': 'Invalid upload.'}, status=404)
+    if not upload.complete:
+        return JsonResponse({'error': 'Upload is incomplete.'}, status=400)
+
+    if upload.size >= settings.FILES_UPLOAD_ASYNC_SIZE:
+        upload.finalizing = True
+        upload.save()
+        task = finalize_upload_task.delay(upload.upload_id)
+        return JsonResponse({'task_id': task.id})
+
+    try:
+        upload.finalize()
+    except Exception as e:
+        error = 'Can not upload "%s": %s' % (upload.filename, str(e))
+        Message.add(request, 'error', error)
+        return JsonResponse({'error': error}, status=409)
+    return JsonResponse({})
 
 @staff_member_required
 def users(request):
@@ -413,18 +557,28 @@ def users(request):
             if username and username != request.user.username:
                 try:
                     user = User.objects.get(username=username)
+                    error = None
                     if action == 'Activate':
                         user.is_active = True
-                        user.create_namespace(request)
-                        user.update_kubernetes_credentials()
+                        try:
+                            user.create_namespace(request)
+                            user.update_kubernetes_credentials()
+                        except Exception as e:
+                            error = str(e)
                     elif action == 'Deactivate':
                         user.is_active = False
-                        user.delete_kubernetes_credentials()
+                        try:
+                            user.delete_kubernetes_credentials()
+                        except Exception as e:
+                            error = str(e)
                     elif action in ('Promote', 'Demote'):
                         user.is_staff = True if action == 'Promote' else False
                     user.save()
                     User.export_to_htpasswd(settings.HTPASSWD_EXPORT_DIR)
-                    Message.add(request, 'success', 'User "%s" %s.' % (username, action.lower() + 'd'))
+                    if error:
+                        Message.add(request, 'error', 'User "%s" %s, but failed to update Kubernetes resources: %s.' % (username, action.lower() + 'd', error))
+                    else:
+                        Message.add(request, 'success', 'User "%s" %s.' % (username, action.lower() + 'd'))
                 except User.DoesNotExist:
                     pass
             else:
@@ -451,19 +605,23 @@ def users(request):
 
         return redirect('users')
 
-    # Fill in the contents.
+    # Fill in the contents (with private folder usage, as last indexed).
+    usage = DirectoryIndex.sizes(os.path.join(settings.FILES_MOUNT_DIR, 'private'))
     contents = []
     for user in User.objects.exclude(profile__is_team=True):
+        size, files = usage.get(user.username, (-1, 0))
         contents.append({'id': user.id,
                          'username': user.username,
                          'email': user.email,
                          'active': 1 if user.is_active else 0,
                          'admin': 1 if user.is_staff else 0,
+                         'usage': size,
+                         'files': files,
                          'actions': True if user.username != request.user.username else False})
 
     # Sort them up.
     sort_by = request.GET.get('sort_by')
-    if sort_by and sort_by in ('username', 'email', 'active', 'admin'):
+    if sort_by and sort_by in ('username', 'email', 'active', 'admin', 'usage'):
         request.session['users_sort_by'] = sort_by
     else:
         sort_by = request.session.get('users_sort_by', 'username')
@@ -527,9 +685,13 @@ def user_change_password(request, username):
         form = SetPasswordForm(user, request.POST)
         if form.is_valid():
             form.save()
-            user.update_kubernetes_credentials()
             User.export_to_htpasswd(settings.HTPASSWD_EXPORT_DIR)
-            Message.add(request, 'success', 'Password changed for user "%s".' % username)
+            try:
+                user.update_kubernetes_credentials()
+            except Exception as e:
+                Message.add(request, 'error', 'Password changed for user "%s", but failed to update Kubernetes credentials: %s.' % (username, str(e)))
+            else:
+                Message.add(request, 'success', 'Password changed for user "%s".' % username)
             return redirect('users')
     else:
         form = SetPasswordForm(user)
@@ -702,9 +864,13 @@ def change_password(request):
         if form.is_valid():
             user = form.save()
             update_session_auth_hash(request, user)
-            user.update_kubernetes_credentials()
             User.export_to_htpasswd(settings.HTPASSWD_EXPORT_DIR)
-            Message.add(request, 'success', 'Password successfully changed.')
+            try:
+                user.update_kubernetes_credentials()
+            except Exception as e:
+                Message.add(request, 'error', 'Password changed, but failed to update Kubernetes credentials: %s.' % str(e))
+            else:
+                Message.add(request, 'success', 'Password successfully changed.')
             return redirect(next_url)
     else:
         form = PasswordChangeForm(request.user)
@@ -13,45 +13,156 @@
 # limitations under the License.
 
 import json
-import jsonpatch
-import copy
+import time
 import base64
+import asyncio
+import weakref
+import threading
 
-from django.http import HttpResponseBadRequest, JsonResponse
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt
+from django.core.cache import caches
 from django.conf import settings
+from asgiref.sync import sync_to_async
+from functools import wraps
 from urllib.parse import urlparse
 
 from .models import User
-from .utils.inject import inject_volumes, inject_variables, validate_hostpath_volumes, inject_ingress_auth, validate_ingress_host
+from .utils.metrics import Counter, Gauge, Histogram
+from .utils.inject import locate_pod_spec, inject_volumes, inject_variables, allowed_hostpaths, validate_hostpath_volumes, inject_ingress_auth, validate_ingress_host
 
 
-def validate_admission_review(request, allowed_operations):
+ADMISSION_CONTEXT_TTL = 300 # Seconds, in case an invalidation is missed.
+
+class AdmissionContext(object):
+    '''
+    What the webhooks need to know about the user owning a namespace, detached from
+    the database. Works in place of a user for the injection functions.
+    '''
+
+    def __init__(self, user):
+        self.username = user.username
+        self.file_domains = user.file_domains
+        self.local_data = user.local_data
+        self.allowed_hostpaths = allowed_hostpaths(self.file_domains, settings.ALLOWED_HOSTPATH_DIRS)
+
+_admission_contexts = {} # Namespace to (expiry, version, context).
+_admission_contexts_lock = threading.Lock()
+
+def admission_context_version_key(namespace):
+    return 'admission-context-version:%s' % namespace
+
+def invalidate_admission_context(namespace):
+    ''' Make all processes build the context for the namespace again (called when the user changes). '''
+    with _admission_contexts_lock:
+        _admission_contexts.pop(namespace, None)
+    key = admission_context_version_key(namespace)
+    try:
+        try:
+            caches['shared'].incr(key)
+        except ValueError:
+            caches['shared'].set(key, 1, None)
+    except:
+        pass
+
+async def admission_context_version(namespace):
+    # Contexts are only reused while the shared version is unchanged (and available).
+    try:
+        return await caches['shared'].aget(admission_context_version_key(namespace), 0)
+    except:
+        return None
+
+def cached_admission_context(namespace, version):
+    if version is None:
+        return None
+    with _admission_contexts_lock:
+        expires, cached_version, context = _admission_contexts.get(namespace, (0, None, None))
+    if context and cached_version == version and expires > time.monotonic():
+        return context
+    return None
+
+def get_admission_context(namespace, version=None):
+    context = cached_admission_context(namespace, version)
+    if context:
+        return context
+
+    context = AdmissionContext(User.objects.get(username=namespace[len('knot-'):]))
+    if version is not None:
+        with _admission_contexts_lock:
+            _admission_contexts[namespace] = (time.monotonic() + ADMISSION_CONTEXT_TTL, version, context)
+    return context
+
+webhook_requests_in_flight = Gauge('knot_webhook_requests_in_flight', 'Admission requests being processed.')
+webhook_requests_queued = Gauge('knot_webhook_requests_queued', 'Admission requests waiting for a free slot.')
+webhook_requests_rejected_total = Counter('knot_webhook_requests_rejected_total', 'Admission requests that timed out waiting for a free slot.')
+
+_webhook_semaphores = weakref.WeakKeyDictionary()
+
+def webhook_semaphore():
+    # Semaphores are bound to an event loop.
+    loop = asyncio.get_running_loop()
+    if loop not in _webhook_semaphores:
+        _webhook_semaphores[loop] = asyncio.Semaphore(settings.WEBHOOK_CONCURRENCY)
+    return _webhook_semaphores[loop]
+
+def admission_webhook(endpoint):
+    '''
+    Decorator for async admission webhook views. Requests beyond the concurrency limit
+    wait for a free slot, up to the queue timeout, and the latency of each is recorded.
+    '''
+
+    latency = Histogram('knot_webhook_request_seconds', 'Admission request latency, including waiting for a free slot.', labels={'endpoint': endpoint})
+
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request):
+            start = time.monotonic()
+            semaphore = webhook_semaphore()
+            webhook_requests_queued.inc()
+            try:
+                await asyncio.wait_for(semaphore.acquire(), settings.WEBHOOK_QUEUE_TIMEOUT or None)
+            except asyncio.TimeoutError:
+                webhook_requests_rejected_total.inc()
+                return HttpResponse('Too many admission requests', status=503)
+            finally:
+                webhook_requests_queued.dec()
+
+            webhook_requests_in_flight.inc()
+            try:
+                return await view(request)
+            finally:
+                webhook_requests_in_flight.dec()
+                semaphore.release()
+                latency.observe(time.monotonic() - start)
+        return wrapper
+    return decorator
+
+async def validate_admission_review(request, allowed_operations):
     data = json.loads(request.body.decode('utf-8'))
     assert(data['kind'] == 'AdmissionReview')
     assert(data['request']['operation'] in allowed_operations)
     request_uid = data['request']['uid']
     namespace = data['request']['namespace']
     assert(namespace.startswith('knot-'))
-    user = User.objects.get(username=namespace[len('knot-'):])
+    version = await admission_context_version(namespace)
+    user = cached_admission_context(namespace, version) or await sync_to_async(get_admission_context)(namespace, version)
     request_service = data['request']['object']
 
     return request_uid, request_service, user
 
 @require_POST
 @csrf_exempt
-def pod_mutate(request):
+@admission_webhook('pod_mutate')
+async def pod_mutate(request):
     try:
-        request_uid, request_service, user = validate_admission_review(request, ['CREATE'])
-        service = copy.deepcopy(request_service)
+        request_uid, request_service, user = await validate_admission_review(request, ['CREATE'])
     except:
         return HttpResponseBadRequest()
 
-    inject_volumes([service], user.file_domains)
-    inject_variables([service], user)
-    patch = jsonpatch.JsonPatch.from_diff(request_service, service)
-    encoded_patch = base64.b64encode(patch.to_string().encode('utf-8')).decode('utf-8')
+    pod_spec = locate_pod_spec(request_service)
+    patch = inject_volumes(request_service, user.file_domains, pod_spec=pod_spec) + inject_variables(request_service, user, pod_spec=pod_spec)
+    encoded_patch = base64.b64encode(json.dumps(patch).encode('utf-8')).decode('utf-8')
 
     response = JsonResponse({'apiVersion': 'admission.k8s.io/v1',
                              'kind': 'AdmissionReview',
@@ -65,26 +176,27 @@ def pod_mutate(request):
 
 @require_POST
 @csrf_exempt
-def pod_validate(request):
+@admission_webhook('pod_validate')
+async def pod_validate(request):
     try:
-        request_uid, request_service, user = validate_admission_review(request, ['CREATE'])
+        request_uid, request_service, user = await validate_admission_review(request, ['CREATE'])
     except:
         return HttpResponseBadRequest()
 
     response = JsonResponse({'apiVersion': 'admission.k8s.io/v1',
                              'kind': 'AdmissionReview',
                              'response': {'uid': request_uid,
-                                          'allowed': validate_hostpath_volumes([request_service], user.file_domains, other_allowed_paths=settings.ALLOWED_HOSTPATH_DIRS),
+                                          'allowed': validate_hostpath_volumes([request_service], user.file_domains, allowed_paths=user.allowed_hostpaths),
                                           'status': {'message': 'Unauthorized volumes check'}}})
     response['X-Log-User'] = user.username
     return response
 
 @require_POST
 @csrf_exempt
-def ingress_mutate(request):
+@admission_webhook('ingress_mutate')
+async def ingress_mutate(request):
     try:
-        request_uid, request_service, user = validate_admission_review(request, ['CREATE'])
-        service = copy.deepcopy(request_service)
+        request_uid, request_service, user = await validate_admission_review(request, ['CREATE'])
     except:
         return HttpResponseBadRequest()
 
@@ -95,9 +207,8 @@ def ingress_mutate(request):
     else:
         auth_config = {'secret': 'knot-auth',
                        'realm': 'Authentication Required - %s' % settings.DASHBOARD_TITLE}
-    inject_ingress_auth([service], auth_config, redirect_ssl=(ingress_url.scheme == 'https'))
-    patch = jsonpatch.JsonPatch.from_diff(request_service, service)
-    encoded_patch = base64.b64encode(patch.to_string().encode('utf-8')).decode('utf-8')
+    patch = inject_ingress_auth(request_service, auth_config, redirect_ssl=(ingress_url.scheme == 'https'))
+    encoded_patch = base64.b64encode(json.dumps(patch).encode('utf-8')).decode('utf-8')
 
     response = JsonResponse({'apiVersion': 'admission.k8s.io/v1',
                              'kind': 'AdmissionReview',
@@ -111,9 +222,10 @@ def ingress_mutate(request):
 
 @require_POST
 @csrf_exempt
-def ingress_validate(request):
+@admission_webhook('ingress_validate')
+async def ingress_validate(request):
     try:
-        request_uid, request_service, user = validate_admission_review(request, ['CREATE'])
+        request_uid, request_service, user = await validate_admission_review(request, ['CREATE'])
     except:
         return HttpResponseBadRequest()
 
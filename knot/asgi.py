@@ -75,5 +75,21 @@ class AsyncImpersonateMiddleware(BaseMiddleware):
         await self.resolve_scope(scope)
         return await super().__call__(scope, receive, send)
 
-application = ProtocolTypeRouter({'http': get_asgi_application(),
+django_application = get_asgi_application()
+
+async def webhooks_application(scope, receive, send):
+    '''
+    Serves only the admission webhooks, to run them in a server of their own,
+    isolated from dashboard traffic.
+    '''
+
+    if scope['type'] != 'http':
+        raise ValueError('Unsupported scope type')
+    if not scope['path'].startswith('/webhooks/'):
+        await send({'type': 'http.response.start', 'status': 404, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': b'Not found'})
+        return
+    await django_application(scope, receive, send)
+
+application = ProtocolTypeRouter({'http': django_application,
                                   'websocket': AllowedHostsOriginValidator(AuthMiddlewareStack(AsyncImpersonateMiddleware(URLRouter(dashboard.routing.websocket_urlpatterns))))})
@@ -62,7 +62,6 @@ INSTALLED_APPS = [
     'crispy_forms',
     'crispy_bootstrap5',
     'impersonate',
-    'chunked_upload',
     'oauth2_provider',
     'django.contrib.admin',
     'django.contrib.auth',
@@ -121,6 +120,7 @@ TEMPLATES = [
                 'django.contrib.messages.context_processors.messages',
                 'dashboard.context_processors.settings',
                 'dashboard.context_processors.teams',
+                'dashboard.context_processors.workspace',
             ],
         },
     },
@@ -137,6 +137,21 @@ CHANNEL_LAYERS = {
     },
 }
 
+# The "shared" cache is seen by all processes (dashboard, websocket and webhook servers, and workers).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+        'OPTIONS': {
+            'socket_connect_timeout': 1,
+            'socket_timeout': 1,
+        },
+    },
+}
+
 # Password hashes
 
 PASSWORD_HASHERS = [
@@ -298,10 +313,27 @@ FILES_URL = os.getenv('KNOT_FILES_URL', 'file://%s' % os.path.join(BASE_DIR, 'fi
 FILES_MOUNT_DIR = os.getenv('KNOT_FILES_MOUNT_DIR', os.path.join(BASE_DIR, 'files'))
 
 
-# Upload path
+# File uploads (chunks must fit in the proxy's body size limit, larger files are moved in place in the background)
+
+FILES_UPLOAD_CHUNK_SIZE = int(os.getenv('KNOT_FILES_UPLOAD_CHUNK_SIZE') or 8 * 1024 * 1024)
+FILES_UPLOAD_PARALLEL_CHUNKS = int(os.getenv('KNOT_FILES_UPLOAD_PARALLEL_CHUNKS') or 4)
+FILES_UPLOAD_ASYNC_SIZE = int(os.getenv('KNOT_FILES_UPLOAD_ASYNC_SIZE') or 1024 * 1024 * 1024)
+
 
-MEDIA_ROOT = FILES_MOUNT_DIR
-CHUNKED_UPLOAD_PATH = 'uploads'
+# Folder downloads (set to "0" to store files in archives without compression)
+
+FILES_ZIP_COMPRESSION = False if os.getenv('KNOT_FILES_ZIP_COMPRESSION', '1') == '0' else True
+
+
+# Items shown per page when listing files
+
+FILES_PAGE_SIZE = int(os.getenv('KNOT_FILES_PAGE_SIZE') or 1000)
+
+
+# File downloads through the proxy ("x-accel-redirect" or "x-sendfile", empty to send from Django)
+
+FILES_SENDFILE = os.getenv('KNOT_FILES_SENDFILE', '').lower()
+FILES_SENDFILE_PREFIX = os.getenv('KNOT_FILES_SENDFILE_PREFIX', '/protected-files/')
 
 
 # Password file export
@@ -337,6 +369,38 @@ if DISABLED_SERVICES_FILE and os.path.isfile(DISABLED_SERVICES_FILE):
         DISABLED_SERVICES = [line.strip() for line in f if line.strip()]
 
 
+# Helm releases (set to "0" to use the helm command instead of reading release secrets directly)
+
+HELM_NATIVE_STORAGE = False if os.getenv('KNOT_HELM_NATIVE_STORAGE', '1') == '0' else True
+
+
+# Seconds that cached services, ingresses, and Helm releases may lag behind (set to "0" to disable caching)
+
+KUBERNETES_CACHE_STALENESS = int(os.getenv('KNOT_KUBERNETES_CACHE_STALENESS') or 30)
+
+
+# Seconds before closing update websockets that have not pinged (set to "0" to keep them open)
+
+WEBSOCKET_IDLE_TIMEOUT = int(os.getenv('KNOT_WEBSOCKET_IDLE_TIMEOUT') or 120)
+
+
+# Seconds to collect user notifications before sending them in one batch (set to "0" to send immediately)
+
+NOTIFICATION_DELAY = float(os.getenv('KNOT_NOTIFICATION_DELAY') or 0.1)
+
+
+# Bearer token for scraping metrics (metrics are not served if unset)
+
+METRICS_TOKEN = os.getenv('KNOT_METRICS_TOKEN', '')
+
+
+# Admission webhook requests processed concurrently, and seconds others may wait before being turned away
+# (keep the wait below the webhooks' timeoutSeconds, as rejected requests fail pod creation)
+
+WEBHOOK_CONCURRENCY = int(os.getenv('KNOT_WEBHOOK_CONCURRENCY') or 32)
+WEBHOOK_QUEUE_TIMEOUT = float(os.getenv('KNOT_WEBHOOK_QUEUE_TIMEOUT') or 20)
+
+
 # Preconfigured service URL prefixes
 
 import re # noqa: E402
@@ -49,5 +49,6 @@ fi
 
 gunicorn -w 4 -t $TIMEOUT -b 0.0.0.0:8000 knot.wsgi:application &
 daphne -b 0.0.0.0 -p 8001 knot.asgi:application &
+daphne -b 0.0.0.0 -p 8002 knot.asgi:webhooks_application &
 wait -n
 exit $?